@@ -0,0 +1,108 @@
+"""
+队列 领取/入队 基准
+python benchmarks/bench_queue.py [行数 默认 1000000] [--drop-index]
+先批量写入 N 条队列 (大部分已完成 少量待执行/失败/死信) 再测量 claim_queue 与 add_queue_function (unique_key 去重) 的延迟
+--drop-index 删除 (queue_status, next_run_at, priority) 与 key 索引 用于对比
+"""
+import os
+import sys
+import time
+import types
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_FILE = os.path.join(tempfile.mkdtemp(), "bench_queue.sqlite3")
+config = types.ModuleType("config")
+config.DB_SQLALCHEMY_DATABASE_URL = "sqlite:///%s" % DB_FILE
+config.DEFAULT_FUNCTION_COMPANY = {"name": "默认", "prefix_name": "site"}
+config.OAUTH_ADMIN_USERS = {"admin": "admin"}
+sys.modules.setdefault("config", config)
+
+from sqlalchemy import insert, text
+
+from yao.db import Engine, BaseModel, SessionLocal
+from yao.function.model import ModelFunctionQueues
+from yao.function.queue.helper import claim_queue, add_queue_function
+from yao.function.queue.registry import queue_handler
+from yao.function.user.schema import SchemasFunctionScopes
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1000000
+DROP_INDEX = "--drop-index" in sys.argv
+CHUNK = 50000
+SAMPLES = 200
+
+
+@queue_handler(module="__main__")
+def noop(queue=None, auth=None, **kwargs):
+    pass
+
+
+def seed():
+    """写入 ROWS 条 95% 已完成 3% 待执行 1% 失败等待重试 1% 死信"""
+    table = ModelFunctionQueues.__table__
+    now = datetime.now()
+    data = {"module": "__main__", "type": "function", "function_name": "noop", "function_data": {}}
+    with Engine.begin() as connection:
+        for start in range(0, ROWS, CHUNK):
+            rows = []
+            for i in range(start, min(start + CHUNK, ROWS)):
+                r = random.random()
+                status = 1 if r < 0.95 else 0 if r < 0.98 else 2 if r < 0.99 else 4
+                next_run_at = now - timedelta(seconds=random.randint(0, 6 * 86400)) if status in [0, 1, 4] else now + timedelta(minutes=10)
+                rows.append({
+                    "uuid": "%032x" % i, "prefix": "site", "username": "site@admin", "priority": random.randint(1, 9), "scope": "bench", "data": data,
+                    "key": "key-%d" % i, "retry": 0 if status in [0, 1] else 5 if status == 4 else 1, "queue_status": status, "next_run_at": next_run_at,
+                    "created_at": next_run_at, "updated_at": next_run_at,
+                })
+            connection.execute(insert(table), rows)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def report(name, values):
+    print("  %-28s p50 %8.3f ms   p95 %8.3f ms   max %8.3f ms" % (name, percentile(values, 0.5), percentile(values, 0.95), max(values) * 1000))
+
+
+def main():
+    BaseModel.metadata.create_all(Engine)
+    started = time.time()
+    seed()
+    print("seeded %d rows in %.1fs (%s)" % (ROWS, time.time() - started, DB_FILE))
+    if DROP_INDEX:
+        with Engine.begin() as connection:
+            for index in ModelFunctionQueues.__table__.indexes:
+                if index.name.endswith("_claim") or index.name.endswith("_key"):
+                    connection.execute(text('DROP INDEX "%s"' % index.name))
+        print("claim/key indexes dropped")
+    with Engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+
+    claims = []
+    for _ in range(SAMPLES):
+        session = SessionLocal()
+        t = time.perf_counter()
+        claim_queue(session=session)
+        claims.append(time.perf_counter() - t)
+        session.close()
+
+    auth = SchemasFunctionScopes(prefix="site", user={"username": "site@admin"})
+    enqueues = []
+    for i in range(SAMPLES):
+        key = "key-%d" % random.randint(0, ROWS * 2)
+        t = time.perf_counter()
+        add_queue_function("__main__", "noop", {}, auth=auth, unique_key=key)
+        enqueues.append(time.perf_counter() - t)
+
+    print("rows=%d samples=%d" % (ROWS, SAMPLES))
+    report("claim_queue", claims)
+    report("add_queue_function(unique)", enqueues)
+    os.remove(DB_FILE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+条件编译 微基准
+python benchmarks/bench_where.py
+对比: 旧的 if/elif 逐条解析 / 缓存的条件编译 (字面值) / bindparam 模板 以及 SQL 编译缓存关闭与开启
+每项取 REPEAT 轮中的最小值 get_query 默认使用 bindparam 模板 不能模板化的条件才回退到字面值
+"""
+import os
+import sys
+import types
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+config = types.ModuleType("config")
+config.DB_SQLALCHEMY_DATABASE_URL = "sqlite://"
+sys.modules.setdefault("config", config)
+
+from sqlalchemy import create_engine, or_
+from sqlalchemy.orm import sessionmaker
+
+from yao.db import BaseModel
+from yao.crud import where_expression
+from yao.function.log.crud import CrudFunctionLog
+
+WHERE = [
+    ("prefix", "site"),
+    ("scope", "like", "user"),
+    ("methods", "in", ["post", "patch"]),
+    ("created_at", "between", [datetime(2023, 1, 1), datetime(2023, 12, 31)]),
+    (["scope", "methods"], "or_like", "post"),
+    ("username", "!=", "_#None"),
+]
+NUMBER = 20000
+REPEAT = 5
+
+
+def legacy_filter(query, model_class, where):
+    """旧实现 每个条件逐条判断并 getattr"""
+    if len(where) == 2:
+        return query.filter(getattr(model_class, where[0]) == where[1])
+    if where[1] == "==" or where[1] == "=" or where[1] == "eq":
+        return query.filter(getattr(model_class, where[0]) == where[2])
+    elif where[1] == "!=" or where[1] == "<>" or where[1] == "><" or where[1] == "neq" or where[1] == "ne":
+        if where[2] != "_#None":
+            return query.filter(getattr(model_class, where[0]) != where[2])
+        return query.filter(or_(getattr(model_class, where[0]) != None, getattr(model_class, where[0]) != ""))
+    elif where[1] in ["like", "ilike"]:
+        return query.filter(getattr(getattr(model_class, where[0]), where[1])("%" + where[2] + "%"))
+    elif where[1] in ["or_like", "or_ilike"]:
+        return query.filter(or_(*[(getattr(getattr(model_class, fil), where[1][3:])("%" + where[2] + "%")) for fil in where[0]]))
+    elif where[1] in ["between"] and type(where[2]) in [list, tuple] and len(where[2]) == 2:
+        return query.filter(getattr(getattr(model_class, where[0]), where[1])(where[2][0], where[2][1]))
+    elif where[1] in ["in"] and type(where[2]) in [list, tuple]:
+        return query.filter(getattr(getattr(model_class, where[0]), "in_")(where[2]))
+    return query
+
+
+def legacy(crud, session):
+    query = session.query(crud.model_class)
+    for where in WHERE:
+        query = legacy_filter(query, crud.model_class, where)
+    return query.order_by(crud.model_class.id.desc()).limit(25).offset(50)
+
+
+def literal(crud, session):
+    query = session.query(crud.model_class).filter(*[where_expression(crud.model_class, where) for where in WHERE])
+    return query.order_by(crud.model_class.id.desc()).limit(25).offset(50)
+
+
+def bind(crud, session):
+    return crud.get_query(session=session, where=WHERE, limit=25, page=3, order=[("id", "desc")])
+
+
+def main():
+    crud = CrudFunctionLog.init()
+    for size in [0, 500]:
+        engine = create_engine("sqlite://", query_cache_size=size)
+        BaseModel.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        print("query_cache_size=%s" % size)
+        for name, build in [("legacy if/elif", legacy), ("compiled literal", literal), ("compiled bindparam", bind)]:
+            # 取多轮最小值 单轮 timeit 受 GC 与调度抖动影响 结果不稳定
+            seconds = min(timeit.repeat(lambda: build(crud, session), number=NUMBER // REPEAT, repeat=REPEAT))
+            executed = min(timeit.repeat(lambda: build(crud, session).all(), number=NUMBER // 10 // REPEAT, repeat=REPEAT))
+            print("  %-20s build %8.2f us   build+execute %8.2f us" % (name, seconds / (NUMBER // REPEAT) * 1e6, executed / (NUMBER // 10 // REPEAT) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    线程安全 有上限 带过期时间的 LRU 缓存
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        """
+        :param maxsize: 最多缓存条数 超出淘汰最久未使用
+        :param ttl: 默认有效秒数
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        获取缓存 过期则删除
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None, expire_at: float = None):
+        """
+        写入缓存
+        :param key:
+        :param value:
+        :param ttl: 有效秒数 默认 self.ttl
+        :param expire_at: 过期时间戳 不超过 ttl
+        :return:
+        """
+        expire = time.time() + (self.ttl if ttl is None else ttl)
+        expire = min(expire, expire_at) if expire_at else expire
+        with self._lock:
+            self._data[key] = (value, expire)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def pop(self, key, default=None):
+        """
+        删除缓存
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def discard(self, predicate):
+        """
+        删除 key 满足条件的缓存
+        :param predicate: function(key) -> bool
+        :return: 删除数量
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
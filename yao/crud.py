@@ -1,26 +1,254 @@
+import json
+import base64
+import importlib
+import threading
 from abc import ABCMeta
-from typing import Union, List, Tuple, Optional
+from functools import lru_cache
+from decimal import Decimal
+from datetime import datetime, date, time
+from typing import Union, List, Tuple, Optional, NamedTuple
 
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, text, bindparam, inspect, insert, TIMESTAMP, DateTime
+from sqlalchemy.orm import selectinload, joinedload, subqueryload
 from sqlalchemy.sql.expression import func
 from pydantic import BaseModel
 
 
+def _like(attr, method, value):
+    return None if value is None else getattr(attr, method)("%" + value + "%")
+
+
+def _pair(value):
+    return type(value) in [list, tuple] and len(value) == 2
+
+
+"""游标值的类型标记 json 不支持的类型编码为 {标记: 字符串}"""
+CURSOR_TYPES = [("$dt", datetime, datetime.fromisoformat), ("$d", date, date.fromisoformat), ("$t", time, time.fromisoformat), ("$dec", Decimal, Decimal)]
+
+
+def _cursor_default(value):
+    for tag, _type, _ in CURSOR_TYPES:
+        if isinstance(value, _type):
+            return {tag: value.isoformat() if hasattr(value, "isoformat") else str(value)}
+    raise TypeError("cursor value %r is not serializable" % (value,))
+
+
+def _cursor_hook(data: dict):
+    for tag, _, parse in CURSOR_TYPES:
+        if len(data) == 1 and tag in data:
+            return parse(data[tag])
+    return data
+
+
+"""条件操作符 (属性, 值) -> 表达式 返回 None 时忽略该条件"""
+WHERE_OPERATORS = {
+    "==": lambda attr, value: or_(attr == None, attr == "") if value == "_#None" else attr == value,
+    "!=": lambda attr, value: or_(attr != None, attr != "") if value == "_#None" else attr != value,
+    ">": lambda attr, value: attr > value,
+    ">=": lambda attr, value: attr >= value,
+    "<": lambda attr, value: attr < value,
+    "<=": lambda attr, value: attr <= value,
+    "like": lambda attr, value: _like(attr, "like", value),
+    "ilike": lambda attr, value: _like(attr, "ilike", value),
+    "between": lambda attr, value: attr.between(value[0], value[1]) if _pair(value) else None,
+    "datebetween": lambda attr, value: attr.between(value[0], value[1]) if _pair(value) else None,
+    "datetimebetween": lambda attr, value: attr.between("%s" % value[0], "%s 23:59:59" % value[1]) if _pair(value) else None,
+    "in": lambda attr, value: attr.in_(value) if type(value) in [list, tuple] else None,
+    "notin": lambda attr, value: attr.notin_(value) if type(value) in [list, tuple] else None,
+    "is": lambda attr, value: attr.is_(value),
+}
+WHERE_OPERATORS.update({alias: WHERE_OPERATORS["=="] for alias in ["=", "eq"]})
+WHERE_OPERATORS.update({alias: WHERE_OPERATORS["!="] for alias in ["<>", "><", "neq", "ne"]})
+WHERE_OPERATORS.update({"gt": WHERE_OPERATORS[">"], "ge": WHERE_OPERATORS[">="], "lt": WHERE_OPERATORS["<"], "le": WHERE_OPERATORS["<="]})
+
+
+@lru_cache(maxsize=4096)
+def compile_where(model_class, column: Union[str, tuple], operator: str = "=="):
+    """
+    编译条件 按 (模型, 字段, 操作符) 缓存 只解析一次字段属性和操作符
+    :param model_class:
+    :param column: 字段 多字段 or 时为 tuple
+    :param operator:
+    :return: 函数 (值) -> 表达式
+    """
+    if operator in ["or", "or_like", "or_ilike"]:
+        method = operator[3:] if operator != "or" else None
+        if type(column) is tuple:
+            """(['name','content'], 'or', '西')"""
+            attrs = [getattr(model_class, _column) for _column in column]
+            if method:
+                return lambda value: or_(*[getattr(attr, method)("%" + value + "%") for attr in attrs])
+            return lambda value: or_(*[attr == value for attr in attrs])
+        attr = getattr(model_class, column)
+        """('name', 'or', ['西', '西'])"""
+        if method:
+            return lambda value: or_(*[getattr(attr, method)("%" + _value + "%") for _value in value]) if type(value) in [list, tuple] else None
+        return lambda value: or_(*[attr == _value for _value in value]) if type(value) in [list, tuple] else None
+    attr = getattr(model_class, column)
+    if operator in WHERE_OPERATORS:
+        build = WHERE_OPERATORS[operator]
+        return lambda value: build(attr, value)
+    method = getattr(attr, operator)
+    return lambda value: method(value)
+
+
+def where_expression(model_class, where: Union[list, tuple, None]):
+    """
+    条件转表达式
+    ('content', '西') ('content', '==', '西') (['name','content'], 'or', '西') ("__or", [("a", b), ("c", "in", [1,2])])
+    :param model_class:
+    :param where:
+    :return:
+    """
+    if not bool(where) or not (type(where) == tuple or type(where) == list):
+        return None
+    if len(where) == 2:
+        if where[0][:2] != "__":
+            return compile_where(model_class, where[0])(where[1])
+        _filters = [where_expression(model_class, fil) for fil in where[1] if fil and (len(fil) == 2 or fil[1] in ["in"])]
+        if where[0][2:] != "or":
+            return or_(*[f for f in _filters if f is not None])
+        return None
+    if len(where) == 3:
+        column = tuple(where[0]) if type(where[0]) in [list, tuple] else where[0]
+        return compile_where(model_class, column, where[1])(where[2])
+    return None
+
+
+"""可预编译为 bindparam 模板的操作符 操作符 -> 参数名"""
+WHERE_BIND_NAMES = {
+    "==": "eq", "=": "eq", "eq": "eq", "!=": "ne", "<>": "ne", "><": "ne", "neq": "ne", "ne": "ne",
+    ">": "gt", "gt": "gt", ">=": "ge", "ge": "ge", "<": "lt", "lt": "lt", "<=": "le", "le": "le",
+    "like": "like", "ilike": "ilike", "in": "in", "notin": "notin",
+    "between": "between", "datebetween": "between", "datetimebetween": "datetimebetween",
+}
+
+
+@lru_cache(maxsize=4096)
+def compile_where_bind(model_class, column: str, operator: str = "=="):
+    """
+    预编译条件模板 值使用 bindparam 占位 表达式只构建一次 SQL 编译缓存键也保持不变
+    :param model_class:
+    :param column:
+    :param operator:
+    :return: (表达式, 函数(值) -> 参数 dict 返回 None 时该值不能使用模板) 不支持的操作符返回 None
+    """
+    kind = WHERE_BIND_NAMES.get(operator)
+    if kind is None or type(column) is not str:
+        return None
+    attr = getattr(model_class, column)
+    name = "w_%s_%s" % (column, kind)
+    if kind in ["eq", "ne"]:
+        expression = attr == bindparam(name) if kind == "eq" else attr != bindparam(name)
+        return expression, lambda value: None if value is None or value == "_#None" else {name: value}  # None 需要 IS NULL
+    if kind in ["gt", "ge", "lt", "le"]:
+        return getattr(attr, "__%s__" % kind)(bindparam(name)), lambda value: {name: value}
+    if kind in ["like", "ilike"]:
+        return getattr(attr, kind)(bindparam(name)), lambda value: None if value is None else {name: "%" + value + "%"}
+    if kind in ["in", "notin"]:
+        expression = attr.in_(bindparam(name, expanding=True)) if kind == "in" else attr.notin_(bindparam(name, expanding=True))
+        return expression, lambda value: {name: list(value)} if type(value) in [list, tuple] else None
+    expression = attr.between(bindparam(name + "_0"), bindparam(name + "_1"))
+    if kind == "datetimebetween":
+        return expression, lambda value: {name + "_0": "%s" % value[0], name + "_1": "%s 23:59:59" % value[1]} if _pair(value) else None
+    return expression, lambda value: {name + "_0": value[0], name + "_1": value[1]} if _pair(value) else None
+
+
+def where_bind(model_class, where: Union[list, tuple, None]):
+    """
+    条件转预编译表达式和参数
+    :param model_class:
+    :param where:
+    :return: (表达式, 参数) 不能预编译时返回 None
+    """
+    if not bool(where) or not (type(where) == tuple or type(where) == list) or type(where[0]) is not str:
+        return None
+    if len(where) == 2 and where[0][:2] != "__":
+        column, operator, value = where[0], "==", where[1]
+    elif len(where) == 3:
+        column, operator, value = where
+    else:
+        return None
+    template = compile_where_bind(model_class, column, operator)
+    params = template and template[1](value)
+    return (template[0], params) if params is not None else None
+
+
+"""预加载策略"""
+LOADER_STRATEGIES = {"selectin": selectinload, "joined": joinedload, "subquery": subqueryload}
+
+
+@lru_cache(maxsize=512)
+def load_options(model_class, load, relations: tuple = (), depth: int = 2):
+    """
+    生成关系预加载选项 避免逐行懒加载 (N+1)
+    :param model_class:
+    :param load: 关系名 tuple 支持 "appointments.permissions" 或 pydantic 返回模型 按字段名匹配关系
+    :param relations: ((关系名, 策略),) 未声明的关系使用 selectin
+    :param depth: 返回模型嵌套的最大层数
+    :return: tuple 选项
+    """
+    strategies = dict(relations)
+
+    def paths_from_schema(_class, schema, _depth):
+        paths = []
+        mapper_relationships = inspect(_class).relationships
+        for name, field in schema.__fields__.items():
+            if name not in mapper_relationships:
+                continue
+            paths.append((name,))
+            inner = field.type_
+            if _depth > 1 and isinstance(inner, type) and issubclass(inner, BaseModel):
+                related = mapper_relationships[name].mapper.class_
+                paths.extend((name,) + path for path in paths_from_schema(related, inner, _depth - 1))
+        return paths
+
+    if isinstance(load, type) and issubclass(load, BaseModel):
+        paths = paths_from_schema(model_class, load, depth)
+    else:
+        paths = [tuple(name.split(".")) for name in load]
+
+    options = []
+    for path in paths:
+        option, _class = None, model_class
+        for index, name in enumerate(path):
+            attr = getattr(_class, name, None)
+            if attr is None or not hasattr(attr, "property") or not hasattr(attr.property, "mapper"):
+                break
+            strategy = strategies.get(name, "selectin") if index == 0 else "selectin"
+            loader = LOADER_STRATEGIES.get(strategy, selectinload)
+            option = loader(attr) if option is None else getattr(option, loader.__name__)(attr)
+            _class = attr.property.mapper.class_
+        else:
+            options.append(option)
+    return tuple(options)
+
+
+class QueryPlan(NamedTuple):
+    """
+    查询计划 每次调用解析一次 不可变 可在线程间共享
+    """
+    where: tuple = ()  # 条件集合
+    order: tuple = ()  # 排序
+    limit: Optional[int] = None  # 页条数
+    page: Optional[int] = None  # 当前页
+    rand: bool = False  # 随机排序
+    join: tuple = ()  # 关联表条件 ((关系名, [条件]), )
+    load: Union[tuple, type] = ()  # 预加载的关系 或 返回模型
+
+
 class Operation(object, metaclass=ABCMeta):
     """
-    模型类
+    模型类 实例不保存查询状态 可按类缓存共享
     """
     model_class = None
     model_pk = "id"
     relationships: dict = {}  # 多对多时使用
     relationship_pk: str = "uuid"  # 多对多传来的值对应的字段　　　
-    relations: dict = {}  # 关联表 用于join等
-    instance = None
-    query = None
+    relations: dict = {}  # 关联表 用于join等 {关系名: 预加载策略 selectin/joined/subquery}
 
-    limit = None
-    page = None
-    order = None
+    _instances: dict = {}  # init 缓存的实例
+    _instances_lock = threading.Lock()
 
     def __init__(self, model_class=None, model_pk=None):
         """
@@ -36,262 +264,258 @@ class Operation(object, metaclass=ABCMeta):
             self.model_pk = model_pk
 
     @classmethod
-    def init(cls, cache=False, **kwargs):
+    def init(cls, cache=True, **kwargs):
         """
-        初始化实例对象
+        初始化实例对象 按 (类, 参数) 缓存 线程安全
         :param cache:
         :param kwargs:
         :return:
         """
-        if not cache or not cls.instance:
-            cls.instance = cls(**kwargs)
-        return cls.instance
+        if not cache:
+            return cls(**kwargs)
+        key = (cls, tuple(sorted(kwargs.items())))
+        try:
+            instance = Operation._instances.get(key)
+        except TypeError:  # 参数不可哈希 不缓存
+            return cls(**kwargs)
+        if instance is None:
+            with Operation._instances_lock:
+                instance = Operation._instances.get(key)
+                if instance is None:
+                    instance = Operation._instances[key] = cls(**kwargs)
+        return instance
 
-    def __init_query(self, session, field=None):
+    def plan(self, **kwargs) -> QueryPlan:
         """
-        初始化查询
+        解析参数生成查询计划
+        :param kwargs:
+        :return:
+        """
+        params = self.__init_params({"where": [], "order": (), "join": []}, **kwargs)
+        params["where"] = tuple(params["where"])
+        params["join"] = tuple(params["join"])
+        params["order"] = tuple(params["order"]) if type(params["order"]) in [list, tuple] else ()
+        return QueryPlan(**params)
+
+    def __init_query(self, session, plan: QueryPlan, field=None, bind: bool = True):
+        """
+        初始化查询 并应用条件
+        :param session:
+        :param plan:
         :param field:
+        :param bind: 使用预编译的 bindparam 条件 更新删除时关闭 (evaluate 同步需要字面值)
         :return:
         """
-        self.limit = None
-        self.page = None
-        self.order = None
-        self.query = session.query(field if field else self.model_class)
-        return self.query
+        query = session.query(field if field else self.model_class)
+        expressions, params = [], {}
+        for where in plan.where:
+            bound = where_bind(self.model_class, where) if bind else None
+            if bound and not any(name in params for name in bound[1]):
+                expressions.append(bound[0])
+                params.update(bound[1])
+            else:
+                expression = where_expression(self.model_class, where)
+                expression is not None and expressions.append(expression)
+        for relation, wheres in plan.join:
+            attr = getattr(self.model_class, relation)
+            related = attr.property.mapper.class_
+            _expressions = [where_expression(related, where) for where in wheres]
+            _expression = and_(*[expression for expression in _expressions if expression is not None])
+            expressions.append(attr.any(_expression) if attr.property.uselist else attr.has(_expression))
+        query = query.filter(*expressions) if expressions else query
+        return query.params(params) if params else query
 
-    def __init_params(self, **kwargs):
+    def __init_params(self, plan: dict, **kwargs):
         """
-        处理kwargs 参数到 params
+        处理kwargs 参数到 plan
+        :param plan:
         :param kwargs:
         :return:
         """
-        [(getattr(self, "_%s" % params)(params_value) if hasattr(self, "_%s" % params) else None) for params, params_value in kwargs.items()]
-        return self
+        [(getattr(self, "_%s" % params)(params_value, plan) if hasattr(self, "_%s" % params) else None) for params, params_value in kwargs.items()]
+        return plan
 
-    def _screen_params(self, params: BaseModel):
+    def _screen_params(self, params: BaseModel, plan: dict):
         """
-        处理screen_params 参数到 params
+        处理screen_params 参数到 plan
         :param params:
+        :param plan:
         :return:
         """
-        self.__init_params(**params.dict())
-        return self
-
-    def __w_tool(self, model_class, where):
-        if where:
-            if len(where) == 2:
-                return getattr(model_class, where[0]) == where[1]
-            elif len(where) == 3:
-                if where[1] in ["in"] and type(where[2]) in [list, tuple]:
-                    return getattr(getattr(model_class, where[0]), "in_")(where[2])
-        return None
+        self.__init_params(plan, **params.dict())
 
-    def __filter_query(self, where: Union[list, tuple, None] = None, query=None, model=None):
+    def __filter_query(self, query, where: Union[list, tuple, None] = None, model=None):
         """
         过滤数据条件
-        :param where:
         :param query:
+        :param where:
         :param model:
         :return:
         """
-        _query = query if query else self.query
-        model_class = model if model else self.model_class
-        if bool(where) and (type(where) == tuple or type(where) == list):
-            if len(where) == 2:
-                """('content', '西')"""
-                if where[0][:2] != "__":
-                    _query = _query.filter(getattr(model_class, where[0]) == where[1])
-                else:
-                    """ ("__or", [("a", b), ("c", "in", [1,2])]) """
-                    _filters = [self.__w_tool(model_class, fil) for fil in where[1]]
-                    if where[0][2:] != "or":
-                        _query = _query.filter(or_(*[f for f in _filters if f is not None]))
-            elif len(where) == 3:
-                if where[1] == "==" or where[1] == "=" or where[1] == "eq":
-                    """('content', '==', '西')"""
-                    if where[2] != "_#None":
-                        _query = _query.filter(getattr(model_class, where[0]) == where[2])
-                    else:
-                        _query = _query.filter(or_(getattr(model_class, where[0]) == None, getattr(model_class, where[0]) == ""))
-                elif where[1] == "!=" or where[1] == "<>" or where[1] == "><" or where[1] == "neq" or where[1] == "ne":
-                    """('content', '!=', '西')"""
-                    if where[2] != "_#None":
-                        _query = _query.filter(getattr(model_class, where[0]) != where[2])
-                    else:
-                        _query = _query.filter(or_(getattr(model_class, where[0]) != None, getattr(model_class, where[0]) != ""))
-                elif where[1] == ">" or where[1] == "gt":
-                    """('content', '>', '西')"""
-                    _query = _query.filter(getattr(model_class, where[0]) > where[2])
-                elif where[1] == ">=" or where[1] == "ge":
-                    """('content', '>=', '西')"""
-                    _query = _query.filter(getattr(model_class, where[0]) >= where[2])
-                elif where[1] == "<" or where[1] == "lt":
-                    """('content', '<', '西')"""
-                    _query = _query.filter(getattr(model_class, where[0]) < where[2])
-                elif where[1] == "<=" or where[1] == "le":
-                    """('content', '<=', '西')"""
-                    _query = _query.filter(getattr(model_class, where[0]) <= where[2])
-                elif where[1] in ["like", "ilike"]:
-                    if not where[2] is None:
-                        """('content', 'like', '西')"""
-                        _query = _query.filter(
-                            getattr(getattr(model_class, where[0]), where[1])("%" + where[2] + "%")
-                        )
-                elif where[1] in ["or"]:
-                    if type(where[0]) == tuple or type(where[0]) == list:
-                        """(['name','content'], 'or', '西')"""
-                        _filters = [(getattr(model_class, fil) == where[2]) for fil in where[0]]
-                        _query = _query.filter(or_(*_filters))
-
-                    if type(where[0]) == str and (type(where[2]) == tuple or type(where[2]) == list):
-                        """('name', 'or', ['西', '西'])"""
-                        _filters = [(getattr(model_class, where[0]) == fil) for fil in where[2]]
-                        _query = _query.filter(or_(*_filters))
-                elif where[1] in ["or_like", "or_ilike"]:
-                    if type(where[0]) == tuple or type(where[0]) == list:
-                        """(['name','content'], 'or_like', '西')"""
-                        _filters = [(getattr(getattr(model_class, fil), where[1][3:])("%" + where[2] + "%")) for
-                                    fil in where[0]]
-                        _query = _query.filter(or_(*_filters))
-                    if type(where[0]) == str and (type(where[2]) == tuple or type(where[2]) == list):
-                        """('name', 'or_like', ['西', '西'])"""
-                        _filters = [(getattr(getattr(model_class, where[0]), where[1][3:])("%" + fil + "%")) for
-                                    fil in where[2]]
-                        _query = _query.filter(or_(*_filters))
-                elif where[1] in ["between"] and type(where[2]) in [list, tuple] and len(where[2]) == 2:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), where[1])(where[2][0], where[2][1]))
-                elif where[1] in ["datebetween"] and type(where[2]) in [list, tuple] and len(where[2]) == 2:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), 'between')(where[2][0], where[2][1]))
-                elif where[1] in ["datetimebetween"] and type(where[2]) in [list, tuple] and len(where[2]) == 2:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), 'between')("%s" % where[2][0], "%s 23:59:59" % where[2][1]))
-                elif where[1] in ["in"] and type(where[2]) in [list, tuple]:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), "in_")(where[2]))
-                elif where[1] in ["is"]:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), "is_")(where[2]))
-                elif where[1] in ["notin"] and type(where[2]) in [list, tuple]:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), "notin_")(where[2]))
-                else:
-                    _query = _query.filter(getattr(getattr(model_class, where[0]), where[1])(where[2]))
-        if not query:
-            self.query = _query
-        return _query
-
-    def _where(self, where: Optional[Union[List[tuple], List[list], Tuple[tuple], Tuple[list], list, tuple, str]] = None, *args):
+        expression = where_expression(model if model else self.model_class, where)
+        return query if expression is None else query.filter(expression)
+
+    def _where(self, where: Optional[Union[List[tuple], List[list], Tuple[tuple], Tuple[list], list, tuple]] = None, plan: dict = None):
         """
         条件集合
         :param where:
-        :param args:
+        :param plan:
         :return:
         """
 
         if where:
             if (type(where) == list or type(where) == tuple) and type(where[0]) == str:
                 where = [where]
-            elif type(where) == str:
-                where = [(where, *args)]
-            [self.__filter_query(where=w) for w in where]
+            plan["where"].extend(w for w in where if w)
+
+    def _join(self, join: Optional[list] = None, plan: dict = None):
+        """
+        关联表条件 [(关系名, [条件], 'join')] 只允许 relations 声明的关系
+        :param join:
+        :param plan:
+        :return:
+        """
+        for _join in join or []:
+            if _join and _join[0] in self.relations:
+                plan["join"].append((_join[0], tuple(_join[1])))
 
-    def _pk(self, pk: int):
+    def _load(self, load, plan: dict):
+        """
+        设置 预加载的关系 关系名列表 或 pydantic 返回模型
+        :param load:
+        :param plan:
+        :return:
+        """
+        plan["load"] = tuple(load) if type(load) in [list, tuple] else load
+
+    def _query_load(self, query, plan: QueryPlan):
+        if plan.load:
+            options = load_options(self.model_class, plan.load, tuple(self.relations.items()))
+            query = query.options(*options) if options else query
+        return query
+
+    def _pk(self, pk: int, plan: dict):
         """
         设定查询 主键
         :param pk:
+        :param plan:
         :return:
         """
-        self._where((self.model_pk, pk))
+        self._where((self.model_pk, pk), plan)
 
-    def _uuid(self, uuid: Union[int, str]):
+    def _uuid(self, uuid: Union[int, str], plan: dict):
         """
         设定查询 uuid
         :param uuid:
+        :param plan:
         :return:
         """
-        self._where(("uuid", uuid))
+        self._where(("uuid", uuid), plan)
 
-    def _uuids(self, uuids: List[Union[int, str]]):
+    def _uuids(self, uuids: List[Union[int, str]], plan: dict):
         """
         设定查询 uuid
         :param uuids:
+        :param plan:
         :return:
         """
-        self._where(("uuid", "in", uuids))
+        self._where(("uuid", "in", uuids), plan)
 
-    def _limit(self, limit):
+    def _limit(self, limit, plan: dict):
         """
         设置 limit
         :param limit:
+        :param plan:
         :return:
         """
-        self.limit = limit
+        plan["limit"] = limit
 
-    def _page(self, page):
+    def _page(self, page, plan: dict):
         """
         设置 page
         :param page:
+        :param plan:
         :return:
         """
-        self.page = page
+        plan["page"] = page
 
-    def _order(self, order):
+    def _order(self, order, plan: dict):
         """
         设置 order
         :param order:
+        :param plan:
         :return:
         """
-        self.order = order
+        plan["order"] = order
 
-    def _rand(self, limit):
+    def _rand(self, limit, plan: dict):
         """
-        设置 order
-        :param order:
+        设置 随机排序
+        :param limit:
+        :param plan:
         :return:
         """
-        self.limit = limit
-        self.query = self.query.order_by(func.rand())
+        plan["limit"] = limit
+        plan["rand"] = True
 
-    def _query_limit_page(self):
-        if self.limit:
-            self.query = self.query.limit(self.limit)
-            if self.page:
-                self.query = self.query.offset((self.page - 1) * self.limit)
+    @staticmethod
+    def _query_limit_page(query, plan: QueryPlan):
+        if plan.limit:
+            query = query.limit(plan.limit)
+            if plan.page:
+                query = query.offset((plan.page - 1) * plan.limit)
+        return query
 
-    def _query_order(self):
-        if bool(self.order):
-            if type(self.order) == tuple or type(self.order) == list:  # 设置排序
-                for attr_item in self.order:
-                    self.query = self.query.order_by(getattr(getattr(self.model_class, attr_item[0]), attr_item[1])())
+    def _query_order(self, query, plan: QueryPlan):
+        if plan.rand:
+            query = query.order_by(func.rand())
+        for attr_item in plan.order:  # 设置排序
+            query = query.order_by(getattr(getattr(self.model_class, attr_item[0]), attr_item[1])())
+        return query
 
-    def get(self, session, field=None, close: bool = False, **kwargs):
+    def get(self, session, field=None, close: bool = False, plan: QueryPlan = None, **kwargs):
         """
         获取列表
         :param session:
         :param field:
         :param close:
+        :param plan: 已解析的查询计划 为空时解析 kwargs
         :param kwargs:
         :return:
         """
-        self.__init_query(session=session, field=field)
-        self.__init_params(**kwargs)
-        self._query_order()
-        self._query_limit_page()
-        response = self.query.all()
+        response = self.get_query(session=session, field=field, plan=plan, **kwargs).all()
         close and session.close()
         return response
 
-    def count(self, session, close: bool = False, **kwargs):
+    def get_query(self, session, field=None, plan: QueryPlan = None, **kwargs):
+        """
+        生成列表查询 不执行
+        :param session:
+        :param field:
+        :param plan:
+        :param kwargs:
+        :return:
+        """
+        plan = plan or self.plan(**kwargs)
+        query = self.__init_query(session=session, plan=plan, field=field)
+        query = self._query_load(self._query_order(query, plan), plan)
+        return self._query_limit_page(query, plan)
+
+    def count(self, session, close: bool = False, plan: QueryPlan = None, **kwargs):
         """
         获取列表
         :param session:
         :param close:
+        :param plan:
         :param kwargs:
         :return:
         """
-        self.__init_query(session=session)
-        self.__init_params(**kwargs)
-        response = self.query.count()
+        plan = plan or self.plan(**kwargs)
+        response = self.__init_query(session=session, plan=plan).count()
         close and session.close()
         return response
 
-    def paginate(self, session, field=None, limit=None, page=None, order=None, close: bool = False, tree: bool = False, **kwargs):
+    def paginate(self, session, field=None, limit=None, page=None, order=None, close: bool = False, tree: bool = False, cursor: str = None, total=None, **kwargs):
         """
         分页 操作
         :param session:
@@ -301,38 +525,167 @@ class Operation(object, metaclass=ABCMeta):
         :param order:
         :param close:
         :param tree:
+        :param cursor: 游标分页 上一次返回的 next_cursor/prev_cursor 空字符串为第一页 None 时使用 screen_params.cursor
+        :param total: 总条数 True 精确统计 False 不统计 "estimate" 估算 None 时使用 screen_params.total 默认精确统计
         :param kwargs:
         :return:
         """
         import math
-        total = self.count(session=session, **kwargs)
+        screen_params = kwargs.get("screen_params")
+        cursor = cursor if cursor is not None else getattr(screen_params, "cursor", None)
+        total = total if total is not None else getattr(screen_params, "total", None)
+        total = True if total is None else total
+        plan = self.plan(limit=limit, page=page, order=order, **kwargs)
+        total = self._paginate_total(session=session, total=total, plan=plan)
+        next_cursor, prev_cursor = None, None
         if tree:
             items = self.get_tree(session=session, json=False)
             items = [item.get("node") for item in items]
+        elif cursor is not None:
+            items, next_cursor, prev_cursor = self.cursor_get(session=session, field=field, cursor=cursor, close=close, plan=plan)
         else:
-            items = self.get(session=session, field=field, limit=limit, page=page, order=order, close=close, **kwargs)
-        pages = math.ceil(total / self.limit) if type(total) is int and type(self.limit) is int and self.limit != 0 else 1
+            items = self.get(session=session, field=field, close=close, plan=plan)
+        pages = math.ceil(total / plan.limit) if type(total) is int and type(plan.limit) is int and plan.limit != 0 else 1
         return {
             "items": items,  # 当前页的数据列表
             "pages": pages,  # 总页数
             "total": total,  # 总条数
-            "page": self.page,  # 当前页
-            "limit": self.limit,  # 页条数
+            "page": plan.page if cursor is None else None,  # 当前页
+            "limit": plan.limit,  # 页条数
+            "next_cursor": next_cursor,  # 下一页游标
+            "prev_cursor": prev_cursor,  # 上一页游标
         }
 
-    def first(self, session, field=None, close: bool = False, **kwargs):
+    def _paginate_total(self, session, plan: QueryPlan, total=True):
+        """
+        分页总条数
+        :param session:
+        :param plan:
+        :param total: True 精确统计 False 不统计 "estimate" 估算
+        :return:
+        """
+        if not total:
+            return None
+        if total == "estimate":
+            estimate = self._estimate_count(session=session, query=self.__init_query(session=session, plan=plan, bind=False))
+            if estimate is not None:
+                return estimate
+        return self.count(session=session, plan=plan)
+
+    @staticmethod
+    def _estimate_count(session, query):
+        """
+        估算条数 MySQL 使用 EXPLAIN 的 rows 其它数据库返回 None
+        :param session:
+        :param query:
+        :return:
+        """
+        dialect = session.get_bind().dialect
+        if dialect.name != "mysql":
+            return None
+        try:
+            sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+            rows = session.execute(text("EXPLAIN %s" % sql)).mappings().all()
+            return int(rows[0]["rows"]) if rows and rows[0]["rows"] is not None else None
+        except Exception:
+            return None
+
+    def _cursor_columns(self, plan: QueryPlan):
+        """
+        游标分页的排序列 (列名, 是否升序) 结尾补主键保证唯一
+        :param plan:
+        :return:
+        """
+        columns = [(attr_item[0], attr_item[1] != "desc") for attr_item in plan.order]
+        if self.model_pk not in [column for column, _ in columns]:
+            columns.append((self.model_pk, columns[-1][1] if columns else True))
+        return columns
+
+    @staticmethod
+    def cursor_encode(columns, item, direction="next"):
+        """
+        生成游标
+        :param columns:
+        :param item:
+        :param direction: next / prev
+        :return:
+        """
+        data = {"c": [column for column, _ in columns], "v": [getattr(item, column, None) for column, _ in columns], "d": direction}
+        return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":"), default=_cursor_default).encode("utf8")).decode("utf8").rstrip("=")
+
+    @staticmethod
+    def cursor_decode(cursor: str):
+        """
+        解析游标
+        :param cursor:
+        :return: (列名, 值, 方向) 无效返回 None
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf8"), object_hook=_cursor_hook)
+            return data["c"], data["v"], data.get("d", "next")
+        except Exception:
+            return None
+
+    def cursor_get(self, session, field=None, cursor: str = "", close: bool = False, plan: QueryPlan = None, **kwargs):
+        """
+        游标分页 (keyset) 不使用 OFFSET
+        :param session:
+        :param field:
+        :param cursor:
+        :param close:
+        :param plan:
+        :param kwargs:
+        :return: (items, next_cursor, prev_cursor)
+        """
+        plan = plan or self.plan(**kwargs)
+        query = self.__init_query(session=session, plan=plan, field=field)
+        columns = self._cursor_columns(plan)
+        decoded = self.cursor_decode(cursor) if cursor else None
+        if decoded and decoded[0] != [column for column, _ in columns]:
+            decoded = None  # 排序已改变 从第一页开始
+        direction = decoded[2] if decoded else "next"
+        forward = direction != "prev"
+        if decoded:
+            seeks = []
+            for index, (column, asc) in enumerate(columns):
+                attr = getattr(self.model_class, column)
+                value = decoded[1][index]
+                equals = [getattr(self.model_class, _column) == decoded[1][_index] for _index, (_column, _) in enumerate(columns[:index])]
+                seeks.append(and_(*equals, attr > value if asc == forward else attr < value))
+            query = query.filter(or_(*seeks))
+        for column, asc in columns:
+            attr = getattr(self.model_class, column)
+            query = query.order_by(attr.asc() if asc == forward else attr.desc())
+        query = self._query_load(query, plan)
+        if plan.limit:
+            query = query.limit(plan.limit + 1)
+        items = query.all()
+        has_more = bool(plan.limit) and len(items) > plan.limit
+        items = items[:plan.limit] if plan.limit else items
+        if not forward:
+            items.reverse()
+        next_cursor, prev_cursor = None, None
+        if items:
+            if has_more or not forward:
+                next_cursor = self.cursor_encode(columns, items[-1], "next")
+            if decoded and (forward or has_more):
+                prev_cursor = self.cursor_encode(columns, items[0], "prev")
+        close and session.close()
+        return items, next_cursor, prev_cursor
+
+    def first(self, session, field=None, close: bool = False, plan: QueryPlan = None, **kwargs):
         """
         获取条件第一个
         :param session:
         :param field:
         :param close:
+        :param plan:
         :param kwargs:
         :return:
         """
-        self.__init_query(session=session, field=field)
-        self.__init_params(**kwargs)
-        self._query_order()
-        response = self.query.first()
+        plan = plan or self.plan(**kwargs)
+        query = self.__init_query(session=session, plan=plan, field=field)
+        response = self._query_load(self._query_order(query, plan), plan).first()
         close and session.close()
         return response
 
@@ -381,9 +734,8 @@ class Operation(object, metaclass=ABCMeta):
                         [getattr(obj_item, relation).remove(rela) for rela in list(getattr(obj_item, relation))]  # 出错
                     hasattr(item, relation) and delattr(item, relation)
             # relationships
-            self.__init_query(session=session)
-            self.__init_params(where=where, **kwargs)
-            self.query.update(item.dict(exclude_unset=exclude_unset), synchronize_session=synchronize_session)
+            query = self.__init_query(session=session, plan=self.plan(where=where, **kwargs), bind=False)
+            query.update(item.dict(exclude_unset=exclude_unset), synchronize_session=synchronize_session)
             commit and session.commit()
             close and session.close()
 
@@ -417,21 +769,108 @@ class Operation(object, metaclass=ABCMeta):
         close and session.close()
         return db_item
 
-    def many_store(self, session, items: List[BaseModel], commit: bool = True, close: bool = False, **kwargs):
+    def many_store(self, session, items: List[Union[BaseModel, dict]], commit: bool = True, close: bool = False, bulk: bool = False, chunk_size: int = 1000,
+                   return_pk: bool = False, upsert: Union[bool, List[str]] = None, conflict: List[str] = None, **kwargs):
         """
         批量创建模型数据
         :param session:
         :param items:
         :param commit:
         :param close:
+        :param bulk: 使用 Core insert executemany 不创建 ORM 对象 不触发 ORM 事件 (树模型不适用)
+        :param chunk_size: bulk 每批条数
+        :param return_pk: bulk 时只返回主键列表
+        :param upsert: bulk 时冲突则更新 True 更新全部提交字段 或 字段名列表 (空列表只更新 updated_at) MySQL ON DUPLICATE KEY UPDATE / SQLite PostgreSQL ON CONFLICT
+        :param conflict: ON CONFLICT 的唯一字段 默认 uuid
         :param kwargs:
-        :return:
+        :return: ORM 对象列表 bulk 时为写入的 dict 列表 或 主键列表
         """
-        db_items = [self.model_class(**item.dict(exclude_unset=True)) for item in items]
-        session.add_all(db_items)
+        if not bulk:
+            db_items = [self.model_class(**(dict(item) if isinstance(item, dict) else item.dict(exclude_unset=True))) for item in items]
+            session.add_all(db_items)
+            commit and session.commit()
+            close and session.close()
+            return db_items
+
+        table = self.model_class.__table__
+        conflict = conflict or ["uuid"]
+        response = []
+        for index in range(0, len(items), chunk_size):
+            rows, keys = self._bulk_rows(table, items[index:index + chunk_size])
+            if not rows:
+                continue
+            session.execute(self._bulk_insert(session, table, keys, upsert=upsert, conflict=conflict), rows)
+            if return_pk:
+                key = "uuid" if upsert is None or upsert is False else conflict[0]
+                pks = dict(session.query(getattr(self.model_class, key), getattr(self.model_class, self.model_pk)).filter(
+                    getattr(self.model_class, key).in_([row[key] for row in rows])).all())
+                response.extend(pks.get(row[key]) for row in rows)
+            else:
+                response.extend(rows)
         commit and session.commit()
         close and session.close()
-        return db_items
+        return response
+
+    @staticmethod
+    def _bulk_rows(table, items: list):
+        """
+        生成批量写入的行 统一字段 一次性补齐默认值 (uuid 每行生成 时间字段同批共用)
+        某行未提交的字段使用字段默认值 而不是 NULL
+        :param table:
+        :param items:
+        :return: (行列表, 提交的字段) upsert 只更新提交的字段
+        """
+        rows = [item.dict(exclude_unset=True) if isinstance(item, BaseModel) else dict(item) for item in items]
+        keys = {key for row in rows for key in row if key in table.c}
+        batch = {}
+        for column in table.columns:
+            if column.default is None or not column.default.is_scalar and not column.default.is_callable:
+                continue
+            if column.default.is_scalar:
+                batch[column.name] = column.default.arg
+            elif isinstance(column.type, (TIMESTAMP, DateTime)):
+                batch[column.name] = column.default.arg(None)
+            else:
+                batch[column.name] = column.default.arg
+
+        def default(name):
+            value = batch.get(name)
+            return value(None) if callable(value) else value
+
+        return [{
+            **{key: row[key] if key in row else default(key) for key in keys},
+            **{name: default(name) for name in batch if name not in keys}
+        } for row in rows], keys
+
+    @staticmethod
+    def _bulk_insert(session, table, keys, upsert: Union[bool, List[str]] = None, conflict: List[str] = None):
+        """
+        生成批量写入语句
+        :param session:
+        :param table:
+        :param keys: 提交的字段 upsert 为 True 时只更新这些字段与 updated_at 补齐的默认值只用于插入
+        :param upsert:
+        :param conflict:
+        :return:
+        """
+        if upsert is None or upsert is False:
+            return insert(table)
+        conflict = conflict or ["uuid"]
+        columns = upsert if type(upsert) in [list, tuple] else [key for key in keys if key not in ["id", "uuid", "created_at", "updated_at"] + conflict]
+        columns = list(columns) + (["updated_at"] if "updated_at" in table.c and "updated_at" not in columns else [])
+        dialect = session.get_bind().dialect.name
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert as dialect_insert
+            stmt = dialect_insert(table)
+            # 没有可更新的字段时 用冲突字段赋值自身 只忽略冲突
+            return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns or conflict[:1]})
+        if dialect in ["sqlite", "postgresql"]:
+            dialect_insert = importlib.import_module("sqlalchemy.dialects.%s" % dialect).insert
+            stmt = dialect_insert(table)
+            if not columns:
+                return stmt.on_conflict_do_nothing(index_elements=conflict)
+            return stmt.on_conflict_do_update(index_elements=conflict, set_={column: stmt.excluded[column] for column in columns})
+        raise NotImplementedError("upsert is not supported for dialect %s" % dialect)
 
     def delete(self, session, commit: bool = True, close: bool = False, event: bool = False, **kwargs):
         """
@@ -443,11 +882,10 @@ class Operation(object, metaclass=ABCMeta):
         :param kwargs:
         :return:
         """
-        self.__init_query(session=session)
-        self.__init_params(**kwargs)
-        self._query_order()
+        plan = self.plan(**kwargs)
+        query = self._query_order(self.__init_query(session=session, plan=plan, bind=False), plan)
 
-        response = [session.delete(u) for u in self.query.all()] if event else self.query.delete()
+        response = [session.delete(u) for u in query.all()] if event else query.delete()
 
         commit and session.commit()
         close and session.close()
@@ -496,6 +934,137 @@ class Operation(object, metaclass=ABCMeta):
             return self.store(session=session, item=item, data=data, commit=commit, refresh=refresh, close=close, **kwargs)
         return instance
 
+    def many_update(self, session, instances: list, items: List[Union[BaseModel, dict]], commit: bool = True, close: bool = False, exclude_unset: bool = True,
+                    bulk: bool = False, **kwargs):
+        """
+        批量更新 instances 与 items 一一对应
+        :param session:
+        :param instances: 已查出的模型对象
+        :param items:
+        :param commit:
+        :param close:
+        :param exclude_unset:
+        :param bulk: 使用 bulk_update_mappings 按主键批量更新 不触发 ORM 事件 (树模型不适用)
+        :param kwargs:
+        :return:
+        """
+        values = [item.dict(exclude_unset=exclude_unset) if isinstance(item, BaseModel) else dict(item) for item in items]
+        if bulk:
+            session.bulk_update_mappings(self.model_class, [
+                {**value, self.model_pk: getattr(instance, self.model_pk)} for instance, value in zip(instances, values)
+            ])
+        else:
+            for instance, value in zip(instances, values):
+                for key, v in value.items():
+                    setattr(instance, key, v)
+        commit and session.commit()
+        close and session.close()
+        return instances
+
+    def _models_by_key(self, session, key: str, values: list):
+        """
+        一次 IN 查询 按 key 返回 {key值: 对象}
+        :param session:
+        :param key:
+        :param values:
+        :return:
+        """
+        if not values:
+            return {}
+        attr = getattr(self.model_class, key)
+        return {getattr(instance, key): instance for instance in session.query(self.model_class).filter(attr.in_(set(values))).all()}
+
+    def update_or_store_models(self, session, key: str, items: List[Union[BaseModel, dict]], store_items: List[Union[BaseModel, dict]] = None, commit: bool = True,
+                               close: bool = False, exclude_unset: bool = True, bulk: bool = False, upsert: bool = False, **kwargs):
+        """
+        批量更新或者创建 一次查询 一次批量创建 一次批量更新 同一个事务
+        :param session:
+        :param key: 查找字段 如 username 需唯一
+        :param items: 更新数据 须包含 key 字段
+        :param store_items: 创建数据 与 items 一一对应 默认使用 items
+        :param commit:
+        :param close:
+        :param exclude_unset:
+        :param bulk: 批量创建/更新 不创建 ORM 对象 (树模型不适用)
+        :param upsert: 使用数据库原生 upsert (MySQL ON DUPLICATE KEY UPDATE / SQLite ON CONFLICT) key 须有唯一索引
+                       插入 store_items 合并 items 的字段 冲突时只更新 items 提交的字段 树模型逐条处理
+        :param kwargs:
+        :return: {key值: 对象}
+        """
+        from sqlalchemy_mptt.mixins import BaseNestedSets
+        keys = [item.get(key) if isinstance(item, dict) else getattr(item, key) for item in items]
+        if upsert and issubclass(self.model_class, BaseNestedSets):
+            # 树模型的 lft rgt 由 mptt 的 ORM 事件维护 不能走 Core upsert
+            upsert, bulk = False, False
+        if upsert:
+            rows = [dict(item) if isinstance(item, dict) else item.dict(exclude_unset=exclude_unset) for item in items]
+            columns = [k for k in dict.fromkeys(k for row in rows for k in row) if k in self.model_class.__table__.c and k not in ["id", "uuid", "created_at", key]]
+            if store_items:
+                rows = [{**(dict(store) if isinstance(store, dict) else store.dict(exclude_unset=exclude_unset)), **row} for store, row in zip(store_items, rows)]
+            self.many_store(session=session, items=rows, commit=False, bulk=True, upsert=columns, conflict=[key], **kwargs)
+            commit and session.commit()
+            instances = self._models_by_key(session=session, key=key, values=keys)
+            close and session.close()
+            return instances
+
+        store_items = store_items or items
+        instances = self._models_by_key(session=session, key=key, values=keys)
+        updates = [(instances[k], item) for k, item in zip(keys, items) if k in instances]
+        stores, seen = [], set()
+        for k, item in zip(keys, store_items):
+            if k not in instances and k not in seen:
+                seen.add(k)
+                stores.append(item)
+        try:
+            updates and self.many_update(session=session, instances=[i for i, _ in updates], items=[item for _, item in updates], commit=False,
+                                         exclude_unset=exclude_unset, bulk=bulk, **kwargs)
+            stored = self.many_store(session=session, items=stores, commit=False, bulk=bulk, **kwargs) if stores else []
+            session.flush()
+        except Exception:
+            session.rollback()
+            raise
+        commit and session.commit()
+        if bulk:
+            instances = self._models_by_key(session=session, key=key, values=keys)
+        else:
+            instances.update({getattr(instance, key): instance for instance in stored})
+        close and session.close()
+        return instances
+
+    def find_or_store_models(self, session, key: str, items: List[Union[BaseModel, dict]], commit: bool = True, close: bool = False, bulk: bool = False, **kwargs):
+        """
+        批量查找或者创建 一次查询 一次批量创建 同一个事务
+        :param session:
+        :param key: 查找字段 需唯一
+        :param items: 创建数据 须包含 key 字段
+        :param commit:
+        :param close:
+        :param bulk: 批量创建 不创建 ORM 对象 (树模型不适用)
+        :param kwargs:
+        :return: {key值: 对象}
+        """
+        keys = [item.get(key) if isinstance(item, dict) else getattr(item, key) for item in items]
+        instances = self._models_by_key(session=session, key=key, values=keys)
+        stores, seen = [], set()
+        for k, item in zip(keys, items):
+            if k not in instances and k not in seen:
+                seen.add(k)
+                stores.append(item)
+        if stores:
+            try:
+                stored = self.many_store(session=session, items=stores, commit=False, bulk=bulk, **kwargs)
+                session.flush()
+            except Exception:
+                session.rollback()
+                raise
+            commit and session.commit()
+            if bulk:
+                instances.update(self._models_by_key(session=session, key=key, values=[k for k in keys if k not in instances]))
+            else:
+                instances.update({getattr(instance, key): instance for instance in stored})
+        close and session.close()
+        return instances
+
     def get_tree(self, session, json=True, json_fields=None, query_function=None, where: Union[list, tuple] = None, **kwargs):
         """
         获取树
@@ -512,8 +1081,8 @@ class Operation(object, metaclass=ABCMeta):
             if _where:
                 if (type(_where) == list or type(_where) == tuple) and type(_where[0]) == str:
                     _where = [_where]
-                for w in where:
-                    nodes = self.__filter_query(where=w, query=nodes)
+                for w in _where:
+                    nodes = self.__filter_query(query=nodes, where=w)
             return nodes
 
         return self.model_class.get_tree(session=session, json=json, json_fields=lambda node: node.to_dict() if json is True and not json_fields else json_fields,
@@ -25,9 +25,10 @@ except:
 from yao.db import session
 from yao.helpers import token_payload
 from yao.schema import ModelScreenParams, ModelScreenParamsForAll
-from yao.function.user.crud import CrudFunctionUser
+from yao.function.user.crud import CrudFunctionUser, auth_cache
 from yao.function.user.schema import SchemasFunctionUser, SchemasFunctionScopes
 from yao.function.log.crud import CrudFunctionLog
+from yao.function.log.helper import LOG_ASYNC, log_writer, log_row
 from yao.function.log.schema import SchemasFunctionStoreUpdate as SchemasStoreUpdateLog
 
 
@@ -60,9 +61,10 @@ def model_post_screen_params_for_all(data: ModelScreenParamsForAll = None):
 
 
 def model_screen_params(page: Optional[str] = None, limit: Optional[str] = None, where: Optional[str] = None, join: Optional[str] = None,
-                        order: Optional[str] = None):
+                        order: Optional[str] = None, cursor: Optional[str] = None, total: Optional[str] = None):
     """列表筛选参数"""
     data = ModelScreenParams(page=json.loads(page).get('value') if page else 1, limit=json.loads(limit).get('value') if limit else 25,
+                             cursor=json.loads(cursor).get('value') if cursor else None, total=json.loads(total).get('value') if total else None,
                              where=json.loads(where).get('value') if where else [], join=json.loads(join).get('value') if join else [],
                              order=json.loads(order).get('value') if order else [])
 
@@ -119,8 +121,17 @@ async def auth_user(auth: SchemasFunctionUser = Security(current_user_security,
     :param session:
     :return:
     """
-    user = CrudFunctionUser.init().first(session=session, pk=auth.user_id)
-    return SchemasFunctionScopes(user=user, prefix=auth.prefix, scopes=auth.scopes, children_ids=user.children_ids)
+    # 同一秒签发的不同 scopes 的令牌不能共用
+    key = (auth.user_id, auth.iat or auth.exp, auth.prefix, tuple(sorted(auth.scopes or [])))
+    scopes = auth_cache.get(key)
+    if scopes is None:
+        from yao.function.appointment.schema import SchemasFunctionMiniAppointmentResponse
+        user = CrudFunctionUser.init().first(session=session, pk=auth.user_id, load=("appointments",))
+        scopes = SchemasFunctionScopes(user=user, prefix=auth.prefix, scopes=auth.scopes, children_ids=user.children_ids)
+        # 转为 pydantic 对象 缓存不持有 session
+        scopes.user.appointments = [SchemasFunctionMiniAppointmentResponse.from_orm(appointment) for appointment in user.appointments]
+        auth_cache.set(key, scopes, expire_at=auth.exp or None)
+    return scopes.copy(deep=True)
 
 
 def item_prefix(callback):
@@ -203,17 +214,18 @@ class DateEncoder(json.JSONEncoder):
 def log_to_database(session=None, scope=None, methods=None, item=None, auth=None, **kwargs):
     prefix = item.prefix if item and hasattr(item, "prefix") and item.prefix else auth.prefix if auth else None
     if ('post' in methods and scope[:5] == ".post") or 'patch' in methods:
-        CrudFunctionLog.init().store(
-            session=session,
-            item=SchemasStoreUpdateLog(prefix=prefix, scope=scope, methods=",".join(methods), data=json.loads(json.dumps(item.dict(exclude_unset=True), cls=DateEncoder)),
-                                       username=auth.user.username),
-            close=False)
-
-    if 'delete' in methods:
-        CrudFunctionLog.init().store(
-            session=session,
-            item=SchemasStoreUpdateLog(prefix=prefix, scope=scope, methods=",".join(methods), data=kwargs.get('uuids'), username=auth.user.username),
-            close=False)
+        data = item.dict(exclude_unset=True)
+    elif 'delete' in methods:
+        data = kwargs.get('uuids')
+    else:
+        return None
+    if LOG_ASYNC:
+        # 后台批量写入 请求内只入队
+        return log_writer.put(log_row(prefix=prefix, scope=scope, methods=",".join(methods), data=data, username=auth.user.username))
+    CrudFunctionLog.init().store(
+        session=session,
+        item=SchemasStoreUpdateLog(prefix=prefix, scope=scope, methods=",".join(methods), data=json.loads(json.dumps(data, cls=DateEncoder)), username=auth.user.username),
+        close=False)
 
 
 def route(path: str, module: str, router: APIRouter, methods: Optional[List[str]] = None, **kwargs):
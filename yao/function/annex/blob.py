@@ -0,0 +1,135 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from yao.function.annex.helper import SpooledUpload, probe_image_size
+
+try:
+    from config import UPLOAD_DIR
+except:
+    UPLOAD_DIR: str = "static"
+try:
+    from config import ANNEX_BLOB_DIR, ANNEX_BLOB_HASH, ANNEX_BLOB_GC_GRACE
+except:
+    # 附件文件目录 按内容哈希 ab/cd/<hash> 存放 各公司共用
+    ANNEX_BLOB_DIR: str = os.path.join(UPLOAD_DIR, "blobs")
+    # 内容哈希算法 md5 / sha256
+    ANNEX_BLOB_HASH: str = "md5"
+    # 未引用的文件保留秒数 之后由 collect_blobs 删除
+    ANNEX_BLOB_GC_GRACE: int = 60 * 60
+
+
+def blob_path(digest: str, extension: str = "") -> str:
+    """
+    内容哈希对应的文件路径
+    :param digest:
+    :param extension: 首次上传的扩展名 便于静态访问识别类型
+    :return:
+    """
+    return os.path.join(ANNEX_BLOB_DIR, digest[:2], digest[2:4], digest + (extension or "")[:10].lower())
+
+
+def store_blob(session, upload: SpooledUpload, extension: str = ""):
+    """
+    保存文件内容并增加引用数 先原子地增加引用数 成功后 collect_blobs 不会再删除该记录 再确认文件存在
+    已存在相同哈希时丢弃上传的临时文件 记录存在但文件缺失时重新写入 只在第一次写入(原子重命名)
+    :param session:
+    :param upload:
+    :param extension:
+    :return: 文件对象
+    """
+    from sqlalchemy.exc import IntegrityError
+    from yao.function.model import ModelFunctionAnnexBlobs
+    table = ModelFunctionAnnexBlobs.__table__
+    for attempt in range(2):
+        if session.execute(table.update().where(table.c.hash == upload.digest).values(refcount=table.c.refcount + 1)).rowcount == 1:
+            blob = session.query(ModelFunctionAnnexBlobs).filter(ModelFunctionAnnexBlobs.hash == upload.digest).one()
+            if os.path.isfile(blob.path):
+                upload.remove()
+            else:
+                upload.replace(blob.path)
+            return blob
+        blob = ModelFunctionAnnexBlobs(hash=upload.digest, algorithm=ANNEX_BLOB_HASH, path=blob_path(upload.digest, extension), size=upload.size, refcount=1)
+        try:
+            with session.begin_nested():
+                session.add(blob)
+        except IntegrityError:
+            # 同时上传了相同内容 重新增加已写入记录的引用数
+            if attempt:
+                raise
+            continue
+        upload.replace(blob.path)
+        return blob
+
+
+def store_annex(session, upload: SpooledUpload, prefix: str, filename: str, content_type: str):
+    """
+    保存附件 本公司已有相同内容时返回已有附件 否则新增指向共用文件的附件记录并增加引用数
+    :param session:
+    :param upload: spool_upload / spool_bytes 写入 ANNEX_BLOB_DIR 的临时文件
+    :param prefix:
+    :param filename:
+    :param content_type:
+    :return: 附件对象
+    """
+    from yao.function.model import ModelFunctionAnnexes
+    db_model = session.query(ModelFunctionAnnexes).filter(ModelFunctionAnnexes.md5 == upload.md5, ModelFunctionAnnexes.prefix == prefix,
+                                                          ModelFunctionAnnexes.blob_hash != None).first()
+    if db_model is not None:
+        upload.remove()
+        return db_model
+    blob = store_blob(session, upload, os.path.splitext(filename or "")[-1])
+    width, height = probe_image_size(upload.head, blob.path)
+    db_model = ModelFunctionAnnexes(prefix=prefix, filename=(filename or os.path.basename(blob.path))[:50], content_type=content_type[:100],
+                                    md5=upload.md5, blob_hash=blob.hash, path=blob.path, size=upload.size, width=width, height=height)
+    session.add(db_model)
+    session.commit()
+    session.refresh(db_model)
+    return db_model
+
+
+def collect_blobs(queue=None, auth=None, grace: int = None, **kwargs) -> dict:
+    """
+    回收未引用的附件文件 先按附件记录重算引用数 再删除超过 grace 秒未引用的文件与残留的临时文件 可作为队列任务执行
+    :param queue:
+    :param auth:
+    :param grace: 秒
+    :return: {"recounted": 修正引用数的条数, "deleted": 删除的文件数, "bytes": 释放的字节数}
+    """
+    from sqlalchemy import select, func, bindparam
+    from yao.db import SessionLocal
+    from yao.function.model import ModelFunctionAnnexes, ModelFunctionAnnexBlobs
+    grace = ANNEX_BLOB_GC_GRACE if grace is None else grace
+    blobs, annexes = ModelFunctionAnnexBlobs.__table__, ModelFunctionAnnexes.__table__
+    response = {"recounted": 0, "deleted": 0, "bytes": 0}
+    session = SessionLocal()
+    try:
+        counts = dict(session.execute(select(annexes.c.blob_hash, func.count()).where(annexes.c.blob_hash != None).group_by(annexes.c.blob_hash)).all())
+        changed = [{"_id": id, "_old": refcount, "_refcount": counts.get(hash, 0)} for id, hash, refcount in session.execute(select(blobs.c.id, blobs.c.hash, blobs.c.refcount))
+                   if refcount != counts.get(hash, 0)]
+        if changed:
+            # 引用数在统计后被上传增加的 不覆盖
+            session.execute(blobs.update().where(blobs.c.id == bindparam("_id"), blobs.c.refcount == bindparam("_old")).values(refcount=bindparam("_refcount")), changed)
+            session.commit()
+        response["recounted"] = len(changed)
+
+        deadline = datetime.now() - timedelta(seconds=grace)
+        for id, path, size in session.execute(select(blobs.c.id, blobs.c.path, blobs.c.size).where(blobs.c.refcount <= 0, blobs.c.updated_at < deadline)).all():
+            # 只删除仍未被引用的 提交前删除文件 记录在提交前保持锁定 同时上传的相同内容在提交后重新写入文件
+            if session.execute(blobs.delete().where(blobs.c.id == id, blobs.c.refcount <= 0)).rowcount == 1:
+                try:
+                    os.path.isfile(path) and os.remove(path)
+                except OSError:
+                    session.rollback()
+                    continue
+                session.commit()
+                response["deleted"] += 1
+                response["bytes"] += size or 0
+    finally:
+        session.close()
+
+    if os.path.isdir(ANNEX_BLOB_DIR):
+        for entry in os.scandir(ANNEX_BLOB_DIR):
+            if entry.name.startswith(".upload-") and entry.is_file() and entry.stat().st_mtime < time.time() - grace:
+                os.remove(entry.path)
+    return response
@@ -0,0 +1,193 @@
+import os
+import struct
+import hashlib
+import tempfile
+
+import filetype
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from config import ANNEX_CHUNK_SIZE
+except:
+    # 上传文件每次读取写入的字节数
+    ANNEX_CHUNK_SIZE: int = 1024 * 1024
+
+
+class SpooledUpload:
+    """
+    已分块写入临时文件的上传 md5 与大小边写边算 head 为第一块 可用于识别类型 digest 为内容哈希(默认即 md5)
+    """
+
+    def __init__(self, path: str, md5: str, size: int, head: bytes, digest: str = None):
+        self.path = path
+        self.md5 = md5
+        self.size = size
+        self.head = head
+        self.digest = digest or md5
+
+    def replace(self, path: str):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+        self.path = path
+
+    async def move(self, path: str) -> str:
+        """
+        原子重命名到目标路径 临时文件与目标在同一文件系统
+        :param path:
+        :return:
+        """
+        await run_in_threadpool(self.replace, path)
+        return path
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def discard(self):
+        """删除临时文件"""
+        await run_in_threadpool(self.remove)
+
+
+def image_size(path: str):
+    """
+    图片宽高 不是图片为 (0, 0)
+    :param path:
+    :return:
+    """
+    try:
+        from PIL import Image
+        with Image.open(path) as img:
+            return img.size
+    except:
+        return 0, 0
+
+
+def _jpeg_size(head: bytes):
+    index = 2
+    while index + 9 < len(head):
+        if head[index] != 0xFF:
+            return None
+        marker = head[index + 1]
+        if marker == 0xFF:
+            index += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            index += 2
+            continue
+        # SOF0-SOF15 除 DHT(C4) JPG(C8) DAC(CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", head[index + 5:index + 9])
+            return width, height
+        index += 2 + struct.unpack(">H", head[index + 2:index + 4])[0]
+    return None
+
+
+def image_header_size(head: bytes):
+    """
+    只读取文件头获取图片宽高 支持 PNG JPEG GIF WebP BMP
+    :param head: 文件开头的内容 JPEG 需包含 SOF 段
+    :return: (宽, 高) 不能识别为 None
+    """
+    try:
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:2] == b"\xff\xd8":
+            return _jpeg_size(head)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            chunk = head[12:16]
+            if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L" and head[20:21] == b"\x2f":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+            return None
+        if head[:2] == b"BM":
+            if struct.unpack("<I", head[14:18])[0] == 12:
+                return struct.unpack("<HH", head[18:22])
+            width, height = struct.unpack("<ii", head[18:26])
+            return abs(width), abs(height)
+    except struct.error:
+        return None
+    return None
+
+
+def probe_image_size(head: bytes, path: str = None):
+    """
+    图片宽高 filetype 判断不是图片直接返回 (0, 0) 先解析文件头 不能识别时才用 Pillow 打开文件
+    :param head: 文件开头的内容
+    :param path: 文件路径 Pillow 回退用
+    :return: (宽, 高)
+    """
+    kind = filetype.guess(head[:8192]) if head else None
+    if kind is None or not kind.mime.startswith("image/"):
+        return 0, 0
+    size = image_header_size(head)
+    if size is not None and all(size):
+        return tuple(size)
+    return image_size(path) if path else (0, 0)
+
+
+def _open_spool(directory: str):
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=directory, prefix=".upload-", delete=False)
+
+
+def _write_chunk(spool, hashes, chunk: bytes):
+    for h in hashes:
+        h.update(chunk)
+    spool.write(chunk)
+
+
+def _hashes(algorithm: str = "md5"):
+    return [hashlib.md5()] + ([hashlib.new(algorithm)] if algorithm and algorithm != "md5" else [])
+
+
+async def spool_upload(file: UploadFile, directory: str, chunk_size: int = ANNEX_CHUNK_SIZE, algorithm: str = "md5") -> SpooledUpload:
+    """
+    分块读取上传文件 增量计算 md5 写入目标目录下的临时文件 磁盘读写均在线程池中执行
+    :param file:
+    :param directory: 目标目录 保证之后的 move 为同一文件系统内的原子重命名
+    :param chunk_size:
+    :param algorithm: 内容哈希算法 md5 / sha256
+    :return:
+    """
+    spool = await run_in_threadpool(_open_spool, directory)
+    hashes, size, head = _hashes(algorithm), 0, b""
+    try:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            head = head or chunk
+            size += len(chunk)
+            await run_in_threadpool(_write_chunk, spool, hashes, chunk)
+        await run_in_threadpool(spool.close)
+    except BaseException:
+        await run_in_threadpool(spool.close)
+        await run_in_threadpool(os.remove, spool.name)
+        raise
+    return SpooledUpload(path=spool.name, md5=hashes[0].hexdigest(), size=size, head=head, digest=hashes[-1].hexdigest())
+
+
+def spool_bytes(content: bytes, directory: str, algorithm: str = "md5") -> SpooledUpload:
+    """
+    已在内存中的内容写入临时文件 同 spool_upload
+    :param content:
+    :param directory:
+    :param algorithm:
+    :return:
+    """
+    hashes = _hashes(algorithm)
+    with _open_spool(directory) as spool:
+        _write_chunk(spool, hashes, content)
+    return SpooledUpload(path=spool.name, md5=hashes[0].hexdigest(), size=len(content), head=content[:ANNEX_CHUNK_SIZE], digest=hashes[-1].hexdigest())
@@ -1,9 +1,9 @@
-import json
 import os
 import requests
 import filetype
 
 from fastapi import APIRouter, Depends, Security, UploadFile, File, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import Optional
 
@@ -11,8 +11,9 @@ from yao.db import session as _session
 from yao.depends import auth_user, route, item_prefix
 from yao.schema import Schemas, SchemasError
 from yao.function.model import function_annex_name as name
-from yao.function.annex.crud import CrudFunctionAnnexe
-from yao.function.annex.schema import SchemasFunctionAnnexeResponse, SchemasFunctionAnnexeStoreUpdate, SchemasUpLoadFileResponse, SchemasUpLoadContentFile
+from yao.function.annex.blob import ANNEX_BLOB_DIR, ANNEX_BLOB_HASH, store_annex
+from yao.function.annex.helper import spool_upload, spool_bytes
+from yao.function.annex.schema import SchemasFunctionAnnexeResponse, SchemasUpLoadFileResponse, SchemasUpLoadContentFile
 from yao.function.user.schema import SchemasFunctionScopes
 
 try:
@@ -20,7 +21,6 @@ try:
 except:
     UPLOAD_DIR: str = "static"
 
-from yao.method import md5_bytes, write_file
 
 router = APIRouter(tags=[name.replace('.', ' ').title()])
 
@@ -36,28 +36,8 @@ async def store_model(file: UploadFile = File(...), session: Session = Depends(_
     :param auth:
     :return:
     """
-    content = await file.read()
-    md5 = md5_bytes(content)
-    size = len(content)
-
-    db_model = CrudFunctionAnnexe.init().first(session=session, where=[("md5", md5), ("prefix", auth.prefix)])
-    if db_model is None:
-        path = os.path.join(UPLOAD_DIR, auth.prefix, os.path.split(file.content_type)[0], "{}{}".format(md5, os.path.splitext(file.filename)[-1]))
-        bool_res = write_file(path, content)
-        if bool_res:
-            try:
-                from PIL import Image
-                img = Image.open(path)
-                width, height = img.size
-            except:
-                width, height = (0, 0)
-            CrudFunctionAnnexe.init().store(session=session,
-                                            item=SchemasFunctionAnnexeStoreUpdate(
-                                                prefix=auth.prefix,
-                                                filename=file.filename[:50],
-                                                content_type=file.content_type,
-                                                md5=md5, path=path, size=size, width=width, height=height))
-            db_model = CrudFunctionAnnexe.init().first(session=session, where=("md5", md5))
+    upload = await spool_upload(file, ANNEX_BLOB_DIR, algorithm=ANNEX_BLOB_HASH)
+    db_model = await run_in_threadpool(store_annex, session, upload, auth.prefix, file.filename, file.content_type)
     return Schemas(data=SchemasFunctionAnnexeResponse(**db_model.to_dict()))
 
 
@@ -155,29 +135,10 @@ async def get_ueditor_models(action: str, session: Session = Depends(_session)):
 
 
 def find_or_create_file(session, content, prefix, filename=None):
-    md5 = md5_bytes(content)
-    size = len(content)
     file = filetype.guess(content)
-    db_model = CrudFunctionAnnexe.init().first(session=session, where=[("md5", md5), ("prefix", prefix)])
-    if db_model is None:
-        path = os.path.join(UPLOAD_DIR, prefix, os.path.split(file.mime)[0], "{}.{}".format(md5, file.extension))
-        bool_res = write_file(path, content)
-        if bool_res:
-            try:
-                from PIL import Image
-                img = Image.open(path)
-                width, height = img.size
-            except:
-                width, height = (0, 0)
-            filename = filename or "{}.{}".format(md5, file.extension)
-            CrudFunctionAnnexe.init().store(
-                session=session, item=SchemasFunctionAnnexeStoreUpdate(
-                    prefix=prefix, filename=filename, content_type=file.mime,
-                    md5=md5, path=path, size=size, width=width, height=height
-                )
-            )
-            db_model = CrudFunctionAnnexe.init().first(session=session, where=("md5", md5))
-    return db_model
+    content_type, extension = (file.mime, file.extension) if file else ("application/octet-stream", "bin")
+    upload = spool_bytes(content, ANNEX_BLOB_DIR, algorithm=ANNEX_BLOB_HASH)
+    return store_annex(session, upload, prefix, filename or "{}.{}".format(upload.md5, extension), content_type)
 
 
 @route('/_M_.ueditor', module=name, router=router, methods=['post'])
@@ -219,6 +180,9 @@ async def content_file_model(path: str = Form(), file: UploadFile = File(...)):
     :param file:
     :return:
     """
-    content = await file.read()
-    bool_res = write_file(path=os.path.join(UPLOAD_DIR, "template", path), content=content)
-    return Schemas() if bool_res else SchemasError()
+    path = os.path.join(UPLOAD_DIR, "template", path)
+    if os.path.isdir(path):
+        return SchemasError()
+    upload = await spool_upload(file, os.path.dirname(path))
+    await upload.move(path)
+    return Schemas()
@@ -29,6 +29,7 @@ class SchemasFunctionAnnexeStoreUpdate(BaseModel):
     filename: Optional[str] = None
     content_type: Optional[str] = None
     md5: Optional[str] = None
+    blob_hash: Optional[str] = None  # 文件内容哈希
     path: Optional[str] = None
     size: Optional[int] = None
     width: Optional[int] = None
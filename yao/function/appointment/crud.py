@@ -1,6 +1,7 @@
 from yao.crud import Operation
 from yao.function.model import ModelFunctionAppointments, ModelFunctionPermissions
 from yao.function.appointment.schema import SchemasFunctionAppointmentStoreUpdate
+from yao.function.user.crud import CrudFunctionUser
 
 
 class CrudFunctionAppointment(Operation):
@@ -9,6 +10,9 @@ class CrudFunctionAppointment(Operation):
     relationships = {
         "permissions": ModelFunctionPermissions
     }
+    relations = {
+        "permissions": "selectin"
+    }
 
     def store(self, session, item: SchemasFunctionAppointmentStoreUpdate = None, **kwargs):
         if item.permissions:
@@ -20,4 +24,11 @@ class CrudFunctionAppointment(Operation):
         if item.permissions:
             _relation = Operation.init(model_class=ModelFunctionPermissions).get(session=session, where=("uuid", 'in_', item.permissions))
             item.scopes = " ".join([relation.scope for relation in _relation])
-        return super().update(session=session, item=item, **kwargs)
+        res = super().update(session=session, item=item, **kwargs)
+        CrudFunctionUser.auth_cache_invalidate()
+        return res
+
+    def delete(self, session, commit: bool = True, close: bool = False, event: bool = False, **kwargs):
+        res = super().delete(session=session, commit=commit, close=close, event=event, **kwargs)
+        CrudFunctionUser.auth_cache_invalidate()
+        return res
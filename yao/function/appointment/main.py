@@ -27,7 +27,7 @@ async def get_models(session: Session = Depends(_session), params: ModelScreenPa
     :param auth:
     :return:
     """
-    db_model_list = CrudFunctionAppointment.init().paginate(session=session, where=[('prefix', auth.prefix)], screen_params=params)
+    db_model_list = CrudFunctionAppointment.init().paginate(session=session, where=[('prefix', auth.prefix)], screen_params=params, load=SchemasFunctionAppointmentResponse)
     return Schemas(data=SchemasFunctionAppointmentPaginateItem(**db_model_list))
 
 
@@ -41,7 +41,7 @@ async def post_models(session: Session = Depends(_session), params: ModelScreenP
     :param auth:
     :return:
     """
-    db_model_list = CrudFunctionAppointment.init().paginate(session=session, screen_params=params)
+    db_model_list = CrudFunctionAppointment.init().paginate(session=session, screen_params=params, load=SchemasFunctionAppointmentResponse)
     return Schemas(data=SchemasFunctionAppointmentPaginateItem(**db_model_list))
 
 
@@ -0,0 +1,319 @@
+import os
+import re
+import gzip
+import json
+from datetime import datetime, date
+
+try:
+    from config import LOG_RETENTION_MONTHS, LOG_ARCHIVE_DIR, LOG_ARCHIVE_BATCH
+except:
+    # 数据库保留最近几个月的日志 更早的按月归档 0 不归档
+    LOG_RETENTION_MONTHS: int = 6
+    # 归档目录 每月一个 YYYY-MM.jsonl.gz
+    LOG_ARCHIVE_DIR: str = "logs/archive"
+    # 每批归档条数
+    LOG_ARCHIVE_BATCH: int = 5000
+
+ARCHIVE_FILE = re.compile(r"^(\d{4})-(\d{2})\.jsonl\.gz$")
+MATCH_OPERATORS = {"==", "=", "eq", "!=", "<>", "><", "neq", "ne", "in", "notin", "like", "ilike", ">", "gt", ">=", "ge", "<", "lt", "<=", "le",
+                   "between", "datebetween", "datetimebetween"}
+DATE_OPERATORS = {"between", "datebetween", "datetimebetween", ">", "gt", ">=", "ge", "<", "lt", "<=", "le", "==", "=", "eq"}
+
+
+def month_start(value: datetime, months: int = 0) -> datetime:
+    """
+    月初 可前后偏移月数
+    :param value:
+    :param months:
+    :return:
+    """
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_path(month: datetime, directory: str = None) -> str:
+    """
+    归档文件路径
+    :param month:
+    :param directory:
+    :return:
+    """
+    return os.path.join(directory or LOG_ARCHIVE_DIR, "%04d-%02d.jsonl.gz" % (month.year, month.month))
+
+
+def archive_months(directory: str = None) -> list:
+    """
+    已归档的月份 升序
+    :param directory:
+    :return: [datetime(月初), ...]
+    """
+    directory = directory or LOG_ARCHIVE_DIR
+    if not os.path.isdir(directory):
+        return []
+    return sorted(datetime(int(m.group(1)), int(m.group(2)), 1) for m in map(ARCHIVE_FILE.match, os.listdir(directory)) if m)
+
+
+def archived_until(directory: str = None):
+    """
+    归档截止时间 早于它的日志只在归档文件中
+    :param directory:
+    :return: datetime 或 None
+    """
+    months = archive_months(directory)
+    return month_start(months[-1], 1) if months else None
+
+
+def archived_max_id(path: str) -> int:
+    """
+    归档文件中最大的日志 id 按 id 顺序追加写入 即已归档的高水位
+    :param path:
+    :return:
+    """
+    if not os.path.isfile(path):
+        return 0
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return max((json.loads(line).get("id") or 0 for line in file), default=0)
+
+
+def archive_logs(queue=None, auth=None, retention_months: int = None, directory: str = None, batch: int = None, **kwargs) -> list:
+    """
+    归档旧日志 按月追加写入 gzip JSONL 写入后再分批删除 可作为队列任务执行
+    写入后删除前失败的 下次只删除 id 不超过归档高水位的行 不重复写入
+    :param queue:
+    :param auth:
+    :param retention_months: 数据库保留月数
+    :param directory:
+    :param batch:
+    :return: 写入的归档文件
+    """
+    from sqlalchemy import select, delete, func
+    from yao.db import SessionLocal
+    from yao.depends import DateEncoder
+    from yao.function.model import ModelFunctionLogs
+    retention_months = LOG_RETENTION_MONTHS if retention_months is None else retention_months
+    if not retention_months:
+        return []
+    directory = directory or LOG_ARCHIVE_DIR
+    batch = batch or LOG_ARCHIVE_BATCH
+    table = ModelFunctionLogs.__table__
+    cutoff = month_start(datetime.now(), -retention_months)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    session = SessionLocal()
+    try:
+        oldest = session.execute(select(func.min(table.c.created_at)).where(table.c.created_at < cutoff)).scalar()
+        month = month_start(oldest) if oldest else cutoff
+        while month < cutoff:
+            end = month_start(month, 1)
+            path = archive_path(month, directory)
+            archived_id = archived_max_id(path)
+            while True:
+                rows = session.execute(select(table).where(table.c.created_at >= month, table.c.created_at < end).order_by(table.c.id).limit(batch)).all()
+                if not rows:
+                    break
+                fresh = [row for row in rows if row.id > archived_id]
+                if fresh:
+                    with gzip.open(path, "at", encoding="utf-8") as file:
+                        file.writelines(json.dumps(dict(row._mapping), cls=DateEncoder, ensure_ascii=False) + "\n" for row in fresh)
+                    archived_id = fresh[-1].id
+                session.execute(delete(table).where(table.c.id.in_([row.id for row in rows])))
+                session.commit()
+                path in paths or paths.append(path)
+            month = end
+    finally:
+        session.close()
+    return paths
+
+
+def read_archive(start: datetime = None, end: datetime = None, directory: str = None):
+    """
+    读取归档日志 只打开 [start, end] 涉及的月份文件
+    :param start:
+    :param end:
+    :param directory:
+    :return: 生成器 dict
+    """
+    for month in archive_months(directory):
+        if start and month_start(month, 1) <= start or end and month > end:
+            continue
+        with gzip.open(archive_path(month, directory), "rt", encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+
+
+def to_datetime(value):
+    """
+    转换为 datetime
+    :param value:
+    :return:
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(str(value).replace("/", "-"))
+
+
+def date_bounds(where: list, column: str = "created_at"):
+    """
+    从筛选条件中取时间范围
+    :param where:
+    :param column:
+    :return: (start, end) 没有限制的一端为 None
+    """
+    start, end = None, None
+    for w in where:
+        if type(w) not in [list, tuple] or len(w) != 3 or w[0] != column or w[1] not in DATE_OPERATORS:
+            continue
+        operator, value = w[1], w[2]
+        if operator in ["between", "datebetween", "datetimebetween"]:
+            low, high = to_datetime(value[0]), to_datetime(value[1])
+            if operator == "datetimebetween":
+                # 同 WHERE_OPERATORS 结束日期补 23:59:59
+                high = datetime(high.year, high.month, high.day, 23, 59, 59)
+        elif operator in [">", "gt", ">=", "ge"]:
+            low, high = to_datetime(value), None
+        elif operator in ["<", "lt", "<=", "le"]:
+            low, high = None, to_datetime(value)
+        else:
+            low = high = to_datetime(value)
+        start = max(start, low) if start and low else start or low
+        end = min(end, high) if end and high else end or high
+    return start, end
+
+
+def _like(pattern: str):
+    return re.compile(".*".join(map(re.escape, str(pattern).split("%"))), re.S | re.I)
+
+
+def match_supported(where: list) -> bool:
+    """
+    筛选条件是否都能在归档中执行
+    :param where:
+    :return:
+    """
+    return all(not w or len(w) == 2 or len(w) == 3 and w[1] in MATCH_OPERATORS for w in where)
+
+
+def match(row: dict, where: list) -> bool:
+    """
+    归档行是否满足筛选条件 支持 == != in notin like ilike > >= < <= between datebetween datetimebetween
+    :param row:
+    :param where:
+    :return:
+    """
+    for w in where:
+        if not w:
+            continue
+        column, operator, value = (w[0], "==", w[1]) if len(w) == 2 else w
+        field = row.get(column)
+        if column in ["created_at", "updated_at", "deleted_at"] and field is not None:
+            field = to_datetime(field)
+            if operator in DATE_OPERATORS:
+                start, end = date_bounds([(column, operator, value)], column=column)
+                if start and field < start or end and field > end:
+                    return False
+                continue
+        if operator in ["==", "=", "eq"]:
+            ok = field in [None, ""] if value == "_#None" else field == value
+        elif operator in ["!=", "<>", "><", "neq", "ne"]:
+            ok = field not in [None, ""] if value == "_#None" else field != value
+        elif operator == "in":
+            ok = field in value
+        elif operator == "notin":
+            ok = field not in value
+        elif operator in ["like", "ilike"]:
+            ok = value is None or field is not None and bool(_like(value).search(str(field)))
+        elif operator in [">", "gt"]:
+            ok = field is not None and field > value
+        elif operator in [">=", "ge"]:
+            ok = field is not None and field >= value
+        elif operator in ["<", "lt"]:
+            ok = field is not None and field < value
+        elif operator in ["<=", "le"]:
+            ok = field is not None and field <= value
+        elif operator == "between":
+            ok = field is not None and value[0] <= field <= value[1]
+        else:
+            raise ValueError("archived logs do not support operator %s" % operator)
+        if not ok:
+            return False
+    return True
+
+
+def match_archive(where: list, directory: str = None):
+    """
+    满足筛选条件的归档日志 只读取时间范围内的月份
+    :param where:
+    :param directory:
+    :return: 生成器 dict
+    """
+    start, end = date_bounds(where)
+    return (row for row in read_archive(start=start, end=end, directory=directory) if match(row, where))
+
+
+def order_key(order: tuple = ()):
+    """
+    排序键 ((字段, asc/desc), ...) None 排在最前 用于 sorted / heapq
+    :param order:
+    :return:
+    """
+    import functools
+    columns = [(column, str(direction).lower() == "desc") for column, direction in order]
+
+    def compare(a: dict, b: dict):
+        for column, desc in columns:
+            x, y = a.get(column), b.get(column)
+            x, y = (x is not None, x), (y is not None, y)
+            if x != y:
+                return (1 if x > y else -1) * (-1 if desc else 1)
+        return 0
+
+    return functools.cmp_to_key(compare)
+
+
+def page_rows(rows, order: tuple = (), limit: int = 25, page: int = 1):
+    """
+    流式排序分页 只保留前 page * limit 行 内存与页码成正比 与归档大小无关
+    :param rows: dict 可迭代对象
+    :param order: ((字段, asc/desc), ...)
+    :param limit:
+    :param page:
+    :return: (当前页的行, 总行数)
+    """
+    import heapq
+    total = 0
+
+    def counted():
+        nonlocal total
+        for row in rows:
+            total += 1
+            yield row
+
+    items = heapq.nsmallest(limit * page, counted(), key=order_key(order))
+    return items[(page - 1) * limit:], total
+
+
+def paginate_archive(where: list, order: tuple = (), limit: int = 25, page: int = 1, directory: str = None) -> dict:
+    """
+    归档日志分页 只读取时间范围内的月份
+    :param where:
+    :param order: ((字段, asc/desc), ...)
+    :param limit:
+    :param page:
+    :param directory:
+    :return: 与 Operation.paginate 相同结构
+    """
+    import math
+    limit = limit or 25
+    page = page or 1
+    items, total = page_rows(match_archive(where, directory=directory), order, limit, page)
+    return {
+        "items": items,  # 当前页的数据列表
+        "pages": math.ceil(total / limit),  # 总页数
+        "total": total,  # 总条数
+        "page": page,  # 当前页
+        "limit": limit,  # 页条数
+        "next_cursor": None,  # 下一页游标
+        "prev_cursor": None,  # 上一页游标
+    }
@@ -5,3 +5,45 @@ from yao.function.model import ModelFunctionLogs as Model
 class CrudFunctionLog(Operation):
     """表操作"""
     model_class = Model
+
+    def paginate(self, session, field=None, limit=None, page=None, order=None, close: bool = False, tree: bool = False, cursor: str = None, total=None, **kwargs):
+        """
+        分页 created_at 范围全部早于归档截止时间时 只读取对应月份的归档文件 跨越截止时间或没有结束时间时 合并归档与数据库
+        没有 created_at 条件时只查询数据库(最近 LOG_RETENTION_MONTHS 个月)
+        归档中不支持的筛选条件 抛出 ValueError
+        """
+        import math
+        from itertools import chain
+        from yao.function.log.archive import archived_until, date_bounds, match_archive, match_supported, paginate_archive, page_rows, to_datetime
+        until = archived_until()
+        if until:
+            plan = self.plan(limit=limit, page=page, order=order, **kwargs)
+            start, end = date_bounds(plan.where)
+            if (start or end) and (not start or start < until):
+                if not match_supported(plan.where):
+                    raise ValueError("归档日志不支持该筛选条件 请限定 created_at 在 %s 之后" % until)
+                if end and end < until:
+                    close and session.close()
+                    return paginate_archive(where=list(plan.where), order=plan.order, limit=plan.limit, page=plan.page)
+                # 跨越归档截止时间 数据库取到当前页为止 与归档流式合并 只保留到当前页的行
+                # 归档写入后删除失败残留在数据库中的行 以数据库为准 跳过归档中的副本
+                leftover = {id for id, in self.get_query(session=session, field=Model.id, plan=plan._replace(where=plan.where + (("created_at", "<", until),), order=(), limit=None, page=None))}
+                archived = ({**row, **{key: to_datetime(row.get(key)) for key in ["created_at", "updated_at", "deleted_at"]}}
+                            for row in match_archive(list(plan.where)) if row.get("id") not in leftover)
+                limit, page = plan.limit or 25, plan.page or 1
+                order = plan.order or (("id", "asc"),)
+                rows = self.get(session=session, plan=plan._replace(order=order, limit=limit * page, page=1))
+                count = self.count(session=session, plan=plan._replace(order=(), limit=None, page=None))
+                close and session.close()
+                items, merged = page_rows(chain(archived, [row.to_dict() for row in rows]), order, limit, page)
+                total = count + merged - len(rows)
+                return {
+                    "items": items,  # 当前页的数据列表
+                    "pages": math.ceil(total / limit),  # 总页数
+                    "total": total,  # 总条数
+                    "page": page,  # 当前页
+                    "limit": limit,  # 页条数
+                    "next_cursor": None,  # 下一页游标
+                    "prev_cursor": None,  # 上一页游标
+                }
+        return super().paginate(session=session, field=field, limit=limit, page=page, order=order, close=close, tree=tree, cursor=cursor, total=total, **kwargs)
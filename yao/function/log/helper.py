@@ -0,0 +1,140 @@
+import json
+import queue
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+
+try:
+    from config import LOG_ASYNC, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_QUEUE_TIMEOUT
+except:
+    # 后台批量写日志 False 为请求内同步写入
+    LOG_ASYNC: bool = True
+    # 队列上限 满了按 LOG_QUEUE_TIMEOUT 等待 超时丢弃
+    LOG_QUEUE_SIZE: int = 10000
+    # 每批最多写入条数
+    LOG_BATCH_SIZE: int = 500
+    # 最长写入间隔 毫秒
+    LOG_FLUSH_INTERVAL: int = 200
+    # 队列满时等待秒数 0 直接丢弃
+    LOG_QUEUE_TIMEOUT: float = 0
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    """
+    后台日志写入 请求只入队 工作线程按 batch_size 条或 interval 毫秒 一次多行 INSERT
+    """
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE, batch_size: int = LOG_BATCH_SIZE, interval: int = LOG_FLUSH_INTERVAL, timeout: float = LOG_QUEUE_TIMEOUT):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.interval = interval / 1000
+        self.timeout = timeout
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        启动工作线程 进程退出时写完剩余日志
+        :return:
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="yao-log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+        return self
+
+    def put(self, row: dict) -> bool:
+        """
+        日志入队 队列满时等待 timeout 秒 仍满则丢弃
+        :param row: 日志字段 data 可为未序列化的 dict/list
+        :return: 是否入队
+        """
+        self._thread is None and self.start()
+        try:
+            self.queue.put(row, block=self.timeout > 0, timeout=self.timeout or None)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        """
+        等待已入队的日志写完
+        :return:
+        """
+        self._thread is not None and self.queue.join()
+
+    def stop(self, timeout: float = 10):
+        """
+        写完剩余日志后停止工作线程
+        :param timeout:
+        :return:
+        """
+        self._stop.set()
+        self._thread is not None and self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                rows = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            deadline = time.monotonic() + self.interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    rows.append(self.queue.get(timeout=remaining) if remaining > 0 and not self._stop.is_set() else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(rows)
+            except Exception:
+                logger.exception("write %d logs failed", len(rows))
+            finally:
+                for _ in rows:
+                    self.queue.task_done()
+
+    @staticmethod
+    def write(rows: list):
+        """
+        一次多行 INSERT 写入日志
+        :param rows:
+        :return:
+        """
+        from yao.db import SessionLocal
+        from yao.depends import DateEncoder
+        from yao.function.log.crud import CrudFunctionLog
+        for row in rows:
+            row["data"] = json.loads(json.dumps(row.get("data"), cls=DateEncoder))
+        session = SessionLocal()
+        try:
+            CrudFunctionLog.init().many_store(session=session, items=rows, bulk=True, chunk_size=len(rows))
+        finally:
+            session.close()
+
+
+log_writer = LogWriter()
+
+
+def log_row(prefix: str = None, scope: str = None, methods: str = None, data=None, username: str = None):
+    """
+    生成日志行 记录请求时间
+    :param prefix:
+    :param scope:
+    :param methods:
+    :param data:
+    :param username:
+    :return:
+    """
+    now = datetime.now()
+    return {"prefix": prefix, "scope": scope, "methods": methods, "data": data, "username": username, "created_at": now, "updated_at": now}
@@ -1,6 +1,6 @@
 from typing import List
 
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Depends, Security, HTTPException, status
 from sqlalchemy.orm import Session
 
 from yao.db import session as _session
@@ -25,7 +25,10 @@ async def post_models(session: Session = Depends(_session), params: ModelScreenP
     :param auth:
     :return:
     """
-    db_model_list = CrudFunctionLog.init().paginate(session=session, where=[('prefix', auth.prefix)], screen_params=params)
+    try:
+        db_model_list = CrudFunctionLog.init().paginate(session=session, where=[('prefix', auth.prefix)], screen_params=params)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     return Schemas(data=SchemasFunctionPaginateItem(**db_model_list))
 
 
@@ -38,7 +41,10 @@ async def post_models(session: Session = Depends(_session), params: ModelScreenP
     :param auth:
     :return:
     """
-    db_model_list = CrudFunctionLog.init().paginate(session=session, screen_params=params)
+    try:
+        db_model_list = CrudFunctionLog.init().paginate(session=session, screen_params=params)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     return Schemas(data=SchemasFunctionPaginateItem(**db_model_list))
 
 
@@ -1,5 +1,6 @@
 import os
-from sqlalchemy import Column, String, Boolean, Text, Integer, ForeignKey, event, Table, JSON, TIMESTAMP
+from datetime import datetime
+from sqlalchemy import Column, String, Boolean, Text, Integer, ForeignKey, event, Table, JSON, TIMESTAMP, Index
 from sqlalchemy.orm import relationship, declared_attr
 from sqlalchemy_mptt.mixins import BaseNestedSets
 
@@ -40,6 +41,10 @@ function_user_table_name = function_user_name.replace('.', '_')
 function_annex_name = plural("%s.annex" % name)
 function_annex_table_name = function_annex_name.replace('.', '_')
 
+"""附件内容"""
+function_annex_blob_name = plural("%s.annex.blob" % name)
+function_annex_blob_table_name = function_annex_blob_name.replace('.', '_')
+
 """日志"""
 function_log_name = plural("%s.log" % name)
 function_log_table_name = function_log_name.replace('.', '_')
@@ -175,8 +180,9 @@ class ModelFunctionAnnexes(BaseCompanyModel):
 
     filename = Column(String(50), nullable=False, comment="文件名")
     content_type = Column(String(100), nullable=False, comment="类型")
-    path = Column(String(100), nullable=True, comment="路径")
+    path = Column(String(191), nullable=True, comment="路径")
     md5 = Column(String(32), nullable=True, comment="md5", index=True)
+    blob_hash = Column(String(64), nullable=True, comment="文件内容哈希", index=True)
     size = Column(Integer, nullable=False, comment="SIZE")
     width = Column(String(100), nullable=True, comment="宽")
     height = Column(String(190), nullable=True, comment="高")
@@ -186,6 +192,24 @@ class ModelFunctionAnnexes(BaseCompanyModel):
         return os.path.join(STATIC_URL, self.path)
 
 
+class ModelFunctionAnnexBlobs(BaseModel):
+    """ 附件文件 按内容哈希存储 各公司的附件共用 """
+    __tablename__ = function_annex_blob_table_name
+
+    hash = Column(String(64), nullable=False, unique=True, comment="内容哈希")
+    algorithm = Column(String(10), nullable=False, comment="哈希算法")
+    path = Column(String(191), nullable=False, comment="路径")
+    size = Column(Integer, nullable=False, comment="SIZE")
+    refcount = Column(Integer, nullable=False, default=0, comment="引用数")
+
+
+@event.listens_for(ModelFunctionAnnexes, 'after_delete')
+def annex_receive_after_delete(mapper, connection, target):
+    if target.blob_hash:
+        table = ModelFunctionAnnexBlobs.__table__
+        connection.execute(table.update().where(table.c.hash == target.blob_hash).values(refcount=table.c.refcount - 1))
+
+
 class ModelFunctionLogs(BaseCompanyModel):
     """ 日志 """
     __tablename__ = function_log_table_name
@@ -198,14 +222,22 @@ class ModelFunctionLogs(BaseCompanyModel):
 class ModelFunctionQueues(BaseCompanyModel):
     """队列"""
     __tablename__ = function_queue_table_name
+    __table_args__ = (
+        Index("%s_claim" % function_queue_table_name, "queue_status", "next_run_at", "priority"),
+    )
     username = Column(String(32), ForeignKey("%s.username" % function_user_table_name, onupdate="CASCADE", ondelete="CASCADE"), index=True, nullable=True, comment="用户")
     priority = Column(Integer, nullable=True, comment="优先级 小的最高")
     scope = Column(String(100), nullable=True, comment="scope")
     data = Column(JSON, nullable=True, comment="Data")
-    key = Column(Text, nullable=True, comment="去重Key")
+    key = Column(String(191), index=True, nullable=True, comment="去重Key")
     start_at = Column(TIMESTAMP, nullable=True, comment="开始时间")
     stop_at = Column(TIMESTAMP, nullable=True, comment="结束时间")
     progress = Column(String(8), nullable=True, comment="进度条")
     progress_text = Column(String(100), nullable=True, comment="进度条")
     retry = Column(Integer, nullable=True, comment="重试次数")
-    queue_status = Column(Integer, nullable=True, comment="状态 0未运行 1成功 2失败")
+    queue_status = Column(Integer, nullable=True, comment="状态 0未运行 1成功 2失败 3运行中 4死信")
+    next_run_at = Column(TIMESTAMP, nullable=True, default=datetime.now, comment="下次执行时间")
+    locked_until = Column(TIMESTAMP, nullable=True, comment="运行租约到期时间")
+    result = Column(JSON, nullable=True, comment="结果")
+    result_annex = Column(String(32), nullable=True, comment="结果附件")
+    result_expire_at = Column(TIMESTAMP, nullable=True, index=True, comment="结果过期时间")
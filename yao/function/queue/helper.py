@@ -1,18 +1,35 @@
-import importlib
+import random
 from datetime import datetime, timedelta
 
 from config import DEFAULT_FUNCTION_COMPANY, OAUTH_ADMIN_USERS
+
+try:
+    from config import QUEUE_MAX_RETRY, QUEUE_RETRY_BASE, QUEUE_RETRY_MAX, QUEUE_EXPIRE_DAYS
+except:
+    # 最多执行次数 仍失败则为死信(4)
+    QUEUE_MAX_RETRY: int = 5
+    # 失败重试的基础间隔 秒 按 2 的次方递增
+    QUEUE_RETRY_BASE: int = 10
+    # 失败重试的最长间隔 秒
+    QUEUE_RETRY_MAX: int = 60 * 60
+    # 超过执行时间多少天未执行的不再执行
+    QUEUE_EXPIRE_DAYS: int = 7
 from yao.function.user.crud import CrudFunctionUser
 
 from yao.function.user.schema import SchemasFunctionScopes
 
 from yao.function.queue.type import queue_function_data
 from yao.function.queue.crud import Crud as QueueCrud
+from yao.function.queue.notify import queue_notifier
+from yao.function.queue.registry import resolve_handler, resolve_queue_data
+from yao.function.queue.progress import QueueProgress, progress_open, progress_reporter, progress_close
+from yao.function.queue.lease import QUEUE_LEASE, QueueLease, lease_until
+from yao.function.queue.result import store_result
 from yao.function.queue.schema import SchemasStoreUpdate as QueueSchemasStoreUpdate, SchemasQueueAuth
 from yao.db import session as _session
 
 
-def add_queue_function(module, name, data=None, auth: SchemasFunctionScopes = None, priority=5, unique_key=None, scope=None) -> bool:
+def add_queue_function(module, name, data=None, auth: SchemasFunctionScopes = None, priority=5, unique_key=None, scope=None, run_at: datetime = None) -> bool:
     """
     添加队列数据
     :param module:
@@ -22,6 +39,7 @@ def add_queue_function(module, name, data=None, auth: SchemasFunctionScopes = No
     :param priority:
     :param unique_key:
     :param scope:
+    :param run_at: 延时执行 执行时间
     :return:
     """
     try:
@@ -31,15 +49,18 @@ def add_queue_function(module, name, data=None, auth: SchemasFunctionScopes = No
             user_name = "%s@%s" % (prefix_name, OAUTH_ADMIN_USERS.keys()[0] if len(OAUTH_ADMIN_USERS) > 1 else "admin")
             user = CrudFunctionUser.init().first(session=session, where=[("username", user_name)])
             auth = SchemasFunctionScopes(user=user, prefix=user.prefix)
+        resolve_handler(module, name)
         data = queue_function_data(module, name, data, auth)
         item = QueueSchemasStoreUpdate(
             prefix=auth.prefix, username=auth.user.username, priority=priority,
-            scope=scope, data=data, key=unique_key, queue_status=0, retry=0
+            scope=scope, data=data, key=unique_key, queue_status=0, retry=0, next_run_at=run_at or datetime.now()
         )
         if unique_key:
-            QueueCrud.init().find_or_store_model(session=session, where=[("key", unique_key), ("queue_status", "in", [0, 3])], item=item, close=True)
+            # 等待重试(2)的同样视为未完成 避免重复入队
+            QueueCrud.init().find_or_store_model(session=session, where=[("key", unique_key), ("queue_status", "in", [0, 2, 3])], item=item, close=True)
         else:
             QueueCrud.init().store(session=session, item=item, close=True)
+        queue_notifier.notify()
         return True
     except:
         return False
@@ -83,67 +104,141 @@ def add_queue_function(module, name, data=None, auth: SchemasFunctionScopes = No
 #     session.close()
 
 
+def queue_claim_where():
+    """
+    可领取的队列条件 next_run_at 为空 (新增该字段前入队的数据) 视为已到期 按 created_at 判断是否过期
+    运行中(3)但租约已过期的 (执行者进程已退出) 可重新领取 locked_until 为空时按 start_at 计算租约
+    :return: 表达式列表
+    """
+    from sqlalchemy import or_, and_
+    model = QueueCrud.model_class
+    now = datetime.now()
+    expire_at = now + timedelta(days=-QUEUE_EXPIRE_DAYS)
+    due = or_(and_(model.next_run_at <= now, model.next_run_at > expire_at), and_(model.next_run_at == None, model.created_at > expire_at))
+    expired = or_(model.locked_until < now, and_(model.locked_until == None, model.start_at < now + timedelta(seconds=-QUEUE_LEASE)))
+    return [or_(and_(model.queue_status.in_([0, 2]), due), and_(model.queue_status == 3, expired))]
+
+
+def claim_queue(session, where=None, exclude_scopes=None):
+    """
+    原子领取一条队列 并标记为运行中(3) 设置租约 locked_until
+    MySQL/PostgreSQL 使用 SELECT ... FOR UPDATE SKIP LOCKED 其它数据库使用 UPDATE ... WHERE 领取条件 比较并设置
+    租约过期重新领取的 上次执行者已退出 计一次重试 超过 QUEUE_MAX_RETRY 为死信(4)
+    :param session:
+    :param where: 额外筛选
+    :param exclude_scopes: 已达到并发上限的 scope
+    :return: 队列对象 或 None
+    """
+    from sqlalchemy import update, or_
+    model = QueueCrud.model_class
+    query = QueueCrud.init().get_query(session=session, where=list(where or []), order=[("priority", "asc")]).filter(*queue_claim_where())
+    if exclude_scopes:
+        query = query.filter(or_(model.scope == None, model.scope.notin_(list(exclude_scopes))))
+    now = datetime.now()
+    values = {"queue_status": 3, "start_at": now, "stop_at": None, "progress": None, "progress_text": None, "locked_until": lease_until()}
+
+    def claim_values(queue):
+        if queue.queue_status != 3:
+            return values
+        retry = (queue.retry or 0) + 1
+        return dict(values, retry=retry) if retry < QUEUE_MAX_RETRY else {"queue_status": 4, "retry": retry, "stop_at": now, "progress_text": "lease expired"}
+
+    if session.get_bind().dialect.name in ["mysql", "postgresql"]:
+        while True:
+            queue = query.with_for_update(skip_locked=True).first()
+            if not queue:
+                session.commit()
+                return None
+            claimed = claim_values(queue)
+            session.execute(update(model).where(model.id == queue.id).values(**claimed))
+            session.commit()
+            if claimed["queue_status"] == 3:
+                return queue
+    for candidate in query.limit(10).all():
+        claimed = claim_values(candidate)
+        result = session.execute(update(model).where(model.id == candidate.id, *queue_claim_where()).values(**claimed))
+        session.commit()
+        if result.rowcount == 1 and claimed["queue_status"] == 3:
+            return candidate
+    return None
+
+
+def retry_delay(retry: int) -> float:
+    """
+    第 retry 次失败后的重试间隔 指数递增 随机抖动 避免同时失败的队列同时重试
+    :param retry:
+    :return: 秒
+    """
+    delay = min(QUEUE_RETRY_MAX, QUEUE_RETRY_BASE * 2 ** retry)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def run_queue(session, queue):
+    """
+    执行已领取的队列 并记录结果 方法的返回值见 yao.function.queue.result.store_result
+    :param session:
+    :param queue:
+    :return: 是否成功
+    """
+    data = queue.data or {}
+    uuid, retry = queue.uuid, queue.retry or 0
+    queue_status, progress = 2, None
+    progress_open(uuid)
+    try:
+        fuc = resolve_queue_data(data)
+        function_data = dict(data.get("function_data", {}))
+        auth_item = SchemasQueueAuth.construct(**function_data.pop("auth", {}))
+        with QueueLease(uuid):
+            value = fuc(queue=uuid, auth=auth_item, **function_data)
+        values = store_result(session=session, queue=queue, value=value)
+        queue_status, progress = 1, "100%"
+    except:
+        session.rollback()
+        queue_status, progress, values = 2, None, {}
+    progress_close(uuid)
+    stop_at = datetime.now()
+    item = QueueSchemasStoreUpdate(queue_status=queue_status, progress=progress, stop_at=stop_at, retry=retry + 1, **values)
+    if queue_status == 2:
+        item.queue_status = 4 if retry + 1 >= QUEUE_MAX_RETRY else 2
+        item.next_run_at = stop_at + timedelta(seconds=retry_delay(retry))
+    QueueCrud.init().update(session=session, uuid=uuid, item=item, event=True, close=False, exclude_unset=True)
+    return queue_status == 1
+
+
 def digestion_queue(where=[]):
     """
-    消化队列
+    消化队列 单线程依次执行 多线程/多进程使用 yao.function.queue.worker.QueueWorker
     :return:
     """
     while True:
         session = next(_session())
-        created_at = datetime.now() + timedelta(days=-7)
-        queue = QueueCrud.init().first(
-            session=session,
-            where=[("queue_status", "in", [0, 2]), ("retry", "<", 5), ("created_at", ">", created_at)] + where,
-            order=[("priority", "asc")]
-        )
-        if not queue:
-            break
-        else:
-            data = queue.data or {}
-            module_name = data.get("module", None)
-            metaclass = importlib.import_module(module_name)
-            if metaclass:
-                if data.get("type") == "function":
-                    function_name = data.get("function_name")
-                    function_data = data.get("function_data", {})
-                    fuc = getattr(metaclass, function_name)
-                    start_at = datetime.now()
-                    QueueCrud.init().update(
-                        session=session, uuid=queue.uuid, event=True, exclude_unset=True, close=False,
-                        item=QueueSchemasStoreUpdate(start_at=start_at, stop_at=None, queue_status=3, progress=None, progress_text=None)
-                    )
-                    try:
-                        auth = function_data.get("auth", {})
-                        auth_item = SchemasQueueAuth(**auth)
-                        if len(auth) > 0:
-                            del function_data["auth"]
-                        fuc(queue=queue.uuid, auth=auth_item, **function_data)
-                        queue_status = 1
-                        progress = "100%"
-                    except:
-                        queue_status = 2
-                        progress = None
-                    item = QueueSchemasStoreUpdate(queue_status=queue_status, progress=progress, stop_at=datetime.now(), retry=queue.retry + 1)
-                    QueueCrud.init().update(session=session, uuid=queue.uuid, item=item, event=True, close=False, exclude_unset=True)
         try:
-            session.close()
-        except:
-            pass
+            queue = claim_queue(session=session, where=where)
+            if not queue:
+                break
+            run_queue(session=session, queue=queue)
+        finally:
+            try:
+                session.close()
+            except:
+                pass
 
 
-def progress_queue(uuid, progress=None, progress_text=None):
+def progress_queue(uuid, progress=None, progress_text=None, force: bool = False):
     """
-    更新进度
+    更新进度 本进程执行中的队列合并频繁的更新 百分比变化或超过 QUEUE_PROGRESS_INTERVAL 毫秒才写入 其它情况直接写入
     :param uuid:
     :param progress:
     :param progress_text:
+    :param force: 立即写入
     :return:
     """
     try:
         if uuid:
-            session = next(_session())
-            QueueCrud.init().update(session=session, uuid=uuid, item=QueueSchemasStoreUpdate(progress=progress, progress_text=progress_text), event=True, exclude_unset=True)
-            session.close()
+            reporter = progress_reporter(uuid)
+            if reporter is None:
+                reporter, force = QueueProgress(uuid), True
+            reporter.update(progress=progress, progress_text=progress_text, force=force)
     except:
         pass
 
@@ -0,0 +1,56 @@
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from config import QUEUE_LEASE
+except:
+    # 运行中队列的租约 秒 执行期间每 1/3 租约续期一次 执行者进程退出后租约到期 队列可被重新领取
+    QUEUE_LEASE: int = 5 * 60
+
+
+def lease_until(lease: int = QUEUE_LEASE) -> datetime:
+    """
+    租约到期时间
+    :param lease:
+    :return:
+    """
+    return datetime.now() + timedelta(seconds=lease)
+
+
+class QueueLease:
+    """
+    运行中队列的租约 后台线程定期用一条 UPDATE ... WHERE uuid 续期 locked_until
+    with QueueLease(uuid):
+        ...
+    """
+
+    def __init__(self, uuid: str, lease: int = QUEUE_LEASE):
+        self.uuid = uuid
+        self.lease = lease
+        self._stop = threading.Event()
+        self._thread = None
+
+    def renew(self):
+        """续期 只续期仍在运行中(3)的队列"""
+        from sqlalchemy import update
+        from yao.db import Engine
+        from yao.function.model import ModelFunctionQueues
+        table = ModelFunctionQueues.__table__
+        with Engine.begin() as connection:
+            connection.execute(update(table).where(table.c.uuid == self.uuid, table.c.queue_status == 3).values(locked_until=lease_until(self.lease)))
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            try:
+                self.renew()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="yao-queue-lease", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
@@ -1,6 +1,11 @@
+import json
+import asyncio
+from datetime import datetime
 from typing import List
 
 from fastapi import APIRouter, Depends, Security
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, FileResponse
 from sqlalchemy.orm import Session
 
 from yao.db import session as _session
@@ -8,6 +13,8 @@ from yao.depends import model_screen_params, model_post_screen_params, auth_user
 from yao.schema import ModelScreenParams, Schemas, SchemasError
 from yao.function.model import function_queue_name as name
 from yao.function.queue.crud import Crud
+from yao.function.queue.progress import progress_snapshot, progress_token, progress_token_payload
+from yao.function.queue.result import result_download, discard_result
 from yao.function.queue.schema import SchemasPaginateItem, SchemasParams, SchemasResponse, SchemasStoreUpdate
 from yao.function.user.schema import SchemasFunctionScopes
 
@@ -44,6 +51,67 @@ async def post_models(session: Session = Depends(_session), params: ModelScreenP
     return Schemas(data=SchemasPaginateItem(**db_model_list))
 
 
+@route('/_M_.progress_token/{uuid}', module=name, router=router, methods=['get'])
+async def progress_token_model(uuid: str, auth: SchemasFunctionScopes = Security(auth_user, scopes=role_scopes + ["%s.list" % name])):
+    """
+    队列进度 SSE 令牌 有效期 QUEUE_PROGRESS_TOKEN_EXPIRE 秒 只能订阅该队列
+    new EventSource(`/_M_.progress/${uuid}?token=${token}`)
+    :param uuid:
+    :param auth:
+    :return:
+    """
+    if await run_in_threadpool(progress_snapshot, uuid, auth.prefix) is None:
+        return SchemasError(message="数据没有找到！")
+    return Schemas(data=progress_token(uuid, auth))
+
+
+@route('/_M_.progress/{uuid}', module=name, router=router, methods=['get'])
+async def progress_model(uuid: str, token: str, interval: float = 1):
+    """
+    队列进度 SSE 进度变化时推送 结束后关闭 EventSource 不能带 Authorization 头 先用 .progress_token 获取令牌
+    :param uuid:
+    :param token: .progress_token 签发的令牌
+    :param interval: 检查间隔 秒
+    :return:
+    """
+    prefix = progress_token_payload(uuid, token).get("prefix")
+
+    async def events():
+        last = None
+        while True:
+            snapshot = await run_in_threadpool(progress_snapshot, uuid, prefix)
+            if snapshot != last:
+                last = snapshot
+                yield "data: %s\n\n" % json.dumps(snapshot, ensure_ascii=False)
+            if not snapshot or snapshot.get("queue_status") not in [0, 3]:
+                break
+            await asyncio.sleep(max(interval, 0.2))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@route('/_M_.result/{uuid}', module=name, router=router, methods=['get'])
+async def result_model(uuid: str, session: Session = Depends(_session), auth: SchemasFunctionScopes = Security(auth_user, scopes=role_scopes + ["%s.list" % name])):
+    """
+    队列结果 JSON 直接返回 文件分块下载
+    :param uuid:
+    :param session:
+    :param auth:
+    :return:
+    """
+    db_model = Crud.init().first(session=session, where=[("uuid", uuid), ("prefix", auth.prefix)])
+    if db_model is None or not db_model.result:
+        return SchemasError(message="数据没有找到！")
+    if db_model.result_expire_at and db_model.result_expire_at < datetime.now():
+        return SchemasError(message="结果已过期！")
+    if db_model.result.get("type") == "json":
+        return Schemas(data=db_model.result.get("value"))
+    annex = await run_in_threadpool(result_download, session, uuid, auth.prefix)
+    if annex is None:
+        return SchemasError(message="文件没有找到！")
+    return FileResponse(annex.path, media_type=annex.content_type, filename=annex.filename)
+
+
 @route('/_M_.params', module=name, router=router, methods=['get'])
 async def params_models(session: Session = Depends(_session), auth: SchemasFunctionScopes = Security(auth_user, scopes=role_scopes + ["%s.list" % name])):
     """
@@ -93,6 +161,7 @@ async def update_patch_model(uuid: str, item: SchemasStoreUpdate, session: Sessi
         item.progress = None
         item.progress_text = None
         item.retry = 0
+        item.next_run_at = item.next_run_at or datetime.now()
     Crud.init().update(session=session, uuid=uuid, item=item, event=True, exclude_unset=True)
     return Schemas()
 
@@ -105,5 +174,7 @@ async def delete_models(uuids: List[str], session: Session = Depends(_session),
     :param auth:
     :return:
     """
+    for db_model in Crud.init().get_query(session=session, where=[("uuid", "in", uuids), ("result_annex", "!=", "_#None")]):
+        discard_result(session=session, queue=db_model)
     bool_model = Crud.init().delete(session=session, uuids=uuids, event=True)
     return Schemas(data=bool_model)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import threading
+
+try:
+    from config import QUEUE_REDIS_URL, QUEUE_NOTIFY_CHANNEL
+except:
+    # 新队列通知 redis 地址 如 redis://localhost:6379/0 为空时只通知本进程
+    QUEUE_REDIS_URL: str = None
+    # 通知频道
+    QUEUE_NOTIFY_CHANNEL: str = "yao:queue"
+
+logger = logging.getLogger(__name__)
+
+
+class QueueNotifier:
+    """
+    新队列通知 add_queue_function 提交后 notify() 唤醒空闲的执行者
+    配置 QUEUE_REDIS_URL 时经 aioredis 发布订阅 跨进程/跨机器 否则只唤醒本进程 (threading.Event / asyncio.Condition)
+    """
+
+    def __init__(self, redis_url: str = QUEUE_REDIS_URL, channel: str = QUEUE_NOTIFY_CHANNEL):
+        self.redis_url = redis_url
+        self.channel = channel
+        self._events = set()
+        self._conditions = {}  # {loop: asyncio.Condition}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._redis = None
+
+    @property
+    def shared(self) -> bool:
+        """是否跨进程通知"""
+        return self._start_redis() is not None
+
+    def _start_redis(self):
+        """
+        在后台事件循环线程中连接 redis 并订阅频道 失败则退回本进程通知
+        :return: redis 客户端 或 None
+        """
+        if not self.redis_url:
+            return None
+        with self._lock:
+            if self._redis is None:
+                try:
+                    import aioredis
+                    self._loop = asyncio.new_event_loop()
+                    threading.Thread(target=self._loop.run_forever, name="yao-queue-notify", daemon=True).start()
+                    self._redis = aioredis.from_url(self.redis_url)
+                    asyncio.run_coroutine_threadsafe(self._listen(), self._loop)
+                except Exception:
+                    logger.exception("queue notify redis unavailable, fallback to local")
+                    self.redis_url = None
+                    return None
+        return self._redis
+
+    async def _listen(self):
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        async for message in pubsub.listen():
+            if message.get("type") == "message":
+                self._wake()
+
+    @staticmethod
+    async def _notify_condition(condition):
+        async with condition:
+            condition.notify_all()
+
+    def _wake(self):
+        """唤醒本进程内的等待者"""
+        with self._lock:
+            events = list(self._events)
+            conditions = list(self._conditions.items())
+        for event in events:
+            event.set()
+        for loop, condition in conditions:
+            if loop.is_closed():
+                with self._lock:
+                    self._conditions.pop(loop, None)
+                continue
+            loop.call_soon_threadsafe(lambda c=condition: asyncio.ensure_future(self._notify_condition(c)))
+
+    def notify(self):
+        """
+        通知有新队列
+        :return:
+        """
+        redis = self._start_redis()
+        if redis is None:
+            return self._wake()
+        asyncio.run_coroutine_threadsafe(redis.publish(self.channel, "1"), self._loop)
+
+    def subscribe(self, event: threading.Event):
+        """
+        通知时 set() 该 event 供线程等待
+        :param event:
+        :return:
+        """
+        self._start_redis()
+        with self._lock:
+            self._events.add(event)
+
+    def unsubscribe(self, event: threading.Event):
+        with self._lock:
+            self._events.discard(event)
+
+    async def wait(self, timeout: float = None) -> bool:
+        """
+        协程等待通知
+        :param timeout: 秒
+        :return: 是否收到通知
+        """
+        self._start_redis()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            condition = self._conditions.setdefault(loop, asyncio.Condition())
+        async with condition:
+            try:
+                await asyncio.wait_for(condition.wait(), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+
+queue_notifier = QueueNotifier()
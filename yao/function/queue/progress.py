@@ -0,0 +1,171 @@
+import threading
+import time
+
+try:
+    from config import QUEUE_PROGRESS_INTERVAL
+except:
+    # 进度最短写入间隔 毫秒 百分比整数变化时立即写入
+    QUEUE_PROGRESS_INTERVAL: int = 500
+
+try:
+    from config import QUEUE_PROGRESS_TOKEN_EXPIRE
+except:
+    # 进度 SSE 令牌有效期 秒 只在建立连接时校验 EventSource 不能带 Authorization 头 令牌放在 ?token= 中
+    QUEUE_PROGRESS_TOKEN_EXPIRE: int = 60
+
+# 进度令牌的 scope 只能用于订阅令牌中 queue 对应的进度
+QUEUE_PROGRESS_TOKEN_SCOPE: str = "queue.progress"
+
+
+def progress_percent(progress):
+    """
+    进度字符串转整数百分比
+    :param progress: "45%" / "45.5" / 45
+    :return: int 或 None
+    """
+    try:
+        return int(float(str(progress).rstrip("%")))
+    except (TypeError, ValueError):
+        return None
+
+
+class QueueProgress:
+    """
+    队列进度 在内存中合并 百分比整数变化或超过 interval 毫秒时 用一条 UPDATE ... WHERE uuid 写入
+    """
+
+    def __init__(self, uuid: str, interval: int = QUEUE_PROGRESS_INTERVAL):
+        self.uuid = uuid
+        self.interval = interval / 1000
+        self.values = {}
+        self.flushed_at = 0
+        self.percent = None
+        self._lock = threading.Lock()
+
+    def update(self, progress=None, progress_text=None, force: bool = False):
+        """
+        记录进度
+        :param progress:
+        :param progress_text:
+        :param force: 立即写入
+        :return: 是否写入
+        """
+        with self._lock:
+            progress is not None and self.values.update(progress=str(progress)[:8])
+            progress_text is not None and self.values.update(progress_text=str(progress_text)[:100])
+            percent = progress_percent(progress) if progress is not None else self.percent
+            due = force or percent != self.percent or time.monotonic() - self.flushed_at >= self.interval
+            self.percent = percent
+            if not due or not self.values:
+                return False
+            values, self.values = self.values, {}
+            self.flushed_at = time.monotonic()
+        self.write(values)
+        return True
+
+    def flush(self):
+        """写入未保存的进度"""
+        return self.update(force=True)
+
+    def write(self, values: dict):
+        from sqlalchemy import update
+        from yao.db import Engine
+        from yao.function.model import ModelFunctionQueues
+        table = ModelFunctionQueues.__table__
+        with Engine.begin() as connection:
+            connection.execute(update(table).where(table.c.uuid == self.uuid).values(**values))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+# 本进程执行中的队列进度 {uuid: QueueProgress} 只由 run_queue 通过 progress_open/progress_close 增删
+_reporters = {}
+_reporters_lock = threading.Lock()
+
+
+def progress_open(uuid: str) -> QueueProgress:
+    """
+    队列开始执行 注册进度记录器 结束时必须调用 progress_close
+    :param uuid:
+    :return:
+    """
+    with _reporters_lock:
+        return _reporters.setdefault(uuid, QueueProgress(uuid))
+
+
+def progress_reporter(uuid: str):
+    """
+    获取执行中队列的进度记录器
+    :param uuid:
+    :return: QueueProgress 不在本进程执行时返回 None
+    """
+    return _reporters.get(uuid)
+
+
+def progress_close(uuid: str):
+    """
+    队列结束 写入并移除进度记录器
+    :param uuid:
+    :return:
+    """
+    with _reporters_lock:
+        reporter = _reporters.pop(uuid, None)
+    reporter and reporter.flush()
+
+
+def progress_snapshot(uuid: str, prefix: str = None):
+    """
+    读取队列状态与进度
+    :param uuid:
+    :param prefix:
+    :return: dict 或 None
+    """
+    from sqlalchemy import select
+    from yao.db import Engine
+    from yao.function.model import ModelFunctionQueues
+    table = ModelFunctionQueues.__table__
+    query = select(table.c.queue_status, table.c.progress, table.c.progress_text).where(table.c.uuid == uuid)
+    if prefix:
+        query = query.where(table.c.prefix == prefix)
+    with Engine.connect() as connection:
+        row = connection.execute(query).first()
+    return dict(row._mapping) if row else None
+
+
+def progress_token(uuid: str, auth) -> str:
+    """
+    签发只能订阅该队列进度的短期令牌
+    :param uuid:
+    :param auth: SchemasFunctionScopes
+    :return: token
+    """
+    from datetime import timedelta
+    from yao.depends import OAUTH_SECRET_KEY, OAUTH_ALGORITHM
+    from yao.helpers import token_access_token
+    return token_access_token(
+        data={"sub": auth.user.username, "prefix": auth.prefix, "queue": uuid, "scopes": [QUEUE_PROGRESS_TOKEN_SCOPE]},
+        key=OAUTH_SECRET_KEY,
+        algorithm=OAUTH_ALGORITHM,
+        expires_delta=timedelta(seconds=QUEUE_PROGRESS_TOKEN_EXPIRE)
+    )
+
+
+def progress_token_payload(uuid: str, token: str) -> dict:
+    """
+    校验进度令牌 登录令牌不能放在 URL 中使用
+    :param uuid:
+    :param token:
+    :return: payload
+    """
+    from fastapi.security import SecurityScopes
+    from yao.depends import OAUTH_SECRET_KEY, OAUTH_ALGORITHM
+    from yao.helpers import token_decode, token_exception
+    security_scopes = SecurityScopes(scopes=[QUEUE_PROGRESS_TOKEN_SCOPE])
+    payload = token_decode(security_scopes, token, OAUTH_SECRET_KEY, OAUTH_ALGORITHM)
+    if payload.get("scopes") != [QUEUE_PROGRESS_TOKEN_SCOPE] or payload.get("queue") != uuid:
+        raise token_exception(security_scopes, detail="Not enough permissions")
+    return payload
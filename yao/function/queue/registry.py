@@ -0,0 +1,90 @@
+import importlib
+import threading
+
+# 队列方法 {(module, function_name): callable}
+QUEUE_HANDLERS = {}
+_lock = threading.Lock()
+
+
+class QueueHandlerError(LookupError):
+    """队列方法不存在或不可调用"""
+
+
+def queue_handler(function_name: str = None, module: str = None):
+    """
+    注册队列方法
+    @queue_handler()
+    def export_users(queue=None, auth=None, **kwargs): ...
+    :param function_name: 默认函数名
+    :param module: 默认函数所在模块
+    :return:
+    """
+
+    def wrap(callback):
+        key = (module or callback.__module__, function_name or callback.__name__)
+        with _lock:
+            QUEUE_HANDLERS[key] = callback
+        return callback
+
+    return wrap
+
+
+def resolve_handler(module: str, function_name: str):
+    """
+    获取队列方法 首次按模块导入后缓存
+    :param module:
+    :param function_name:
+    :return: callable
+    """
+    key = (module, function_name)
+    handler = QUEUE_HANDLERS.get(key)
+    if handler is not None:
+        return handler
+    try:
+        handler = getattr(importlib.import_module(module), function_name, None) if module and function_name else None
+    except ImportError as e:
+        raise QueueHandlerError("queue handler %s.%s: %s" % (module, function_name, e))
+    if not callable(handler):
+        raise QueueHandlerError("queue handler %s.%s not found" % (module, function_name))
+    with _lock:
+        return QUEUE_HANDLERS.setdefault(key, handler)
+
+
+def resolve_queue_data(data: dict):
+    """
+    获取队列数据对应的方法
+    :param data: queue_function_data 生成的数据
+    :return: callable
+    """
+    data = data or {}
+    if data.get("type") != "function":
+        raise QueueHandlerError("queue type %s not supported" % data.get("type"))
+    return resolve_handler(data.get("module"), data.get("function_name"))
+
+
+def validate_handlers(session, where: list = None):
+    """
+    执行者启动时 校验待执行队列的方法 每个 (module, function_name) 只解析一次 不存在的直接标记为死信
+    :param session:
+    :param where:
+    :return: {(module, function_name): 错误信息}
+    """
+    from sqlalchemy import update
+    from yao.function.queue.crud import Crud as QueueCrud
+    from yao.function.queue.helper import queue_claim_where
+    model = QueueCrud.model_class
+    errors, invalid = {}, []
+    for queue_id, data in QueueCrud.init().get_query(session=session, where=list(where or [])).filter(*queue_claim_where()).with_entities(model.id, model.data):
+        data = data or {}
+        key = (data.get("module"), data.get("function_name"))
+        if key not in errors:
+            try:
+                resolve_queue_data(data)
+                errors[key] = None
+            except QueueHandlerError as e:
+                errors[key] = str(e)
+        errors[key] and invalid.append((queue_id, errors[key]))
+    for queue_id, error in invalid:
+        session.execute(update(model).where(model.id == queue_id).values(queue_status=4, progress_text=error[:100]))
+    invalid and session.commit()
+    return {key: error for key, error in errors.items() if error}
@@ -0,0 +1,172 @@
+import os
+import json
+import shutil
+import mimetypes
+from datetime import datetime, timedelta
+
+try:
+    from config import QUEUE_RESULT_INLINE_MAX, QUEUE_RESULT_TTL
+except:
+    # 结果 JSON 不超过多少字节直接存入队列 超过则写入附件
+    QUEUE_RESULT_INLINE_MAX: int = 64 * 1024
+    # 结果保留秒数 过期由 clean_results 清理 0 永久保留
+    QUEUE_RESULT_TTL: int = 7 * 24 * 60 * 60
+try:
+    from config import UPLOAD_DIR
+except:
+    UPLOAD_DIR: str = "static"
+
+
+class QueueResultFile:
+    """
+    队列方法返回文件 可指定下载文件名与类型 只有返回 QueueResultFile 才作为文件保存 字符串路径按 JSON 保存
+    return QueueResultFile(path, filename="用户.xlsx")
+    :param move: 移动到结果目录 默认复制 保留原文件
+    """
+
+    def __init__(self, path, filename: str = None, content_type: str = None, move: bool = False):
+        self.path = os.fspath(path)
+        self.filename = filename or os.path.basename(self.path)
+        self.content_type = content_type or mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+        self.move = move
+
+
+def result_file(value):
+    """
+    返回值是否为文件
+    :param value:
+    :return: QueueResultFile 或 None
+    """
+    return value if isinstance(value, QueueResultFile) else None
+
+
+def result_annex_path(prefix: str, uuid: str, filename: str) -> str:
+    """
+    结果附件路径
+    :param prefix:
+    :param uuid: 队列 uuid
+    :param filename:
+    :return:
+    """
+    return os.path.join(UPLOAD_DIR, prefix or "", "queue", "{}{}".format(uuid, os.path.splitext(filename)[-1][:10]))
+
+
+def store_annex(session, prefix: str, uuid: str, file: QueueResultFile, move: bool = None):
+    """
+    结果文件移入附件目录 并写入附件表
+    :param session:
+    :param prefix:
+    :param uuid: 队列 uuid
+    :param file:
+    :param move: 移动 否则复制 默认 file.move
+    :return: 附件对象
+    """
+    move = file.move if move is None else move
+    from yao.method import md5_file
+    from yao.function.annex.crud import CrudFunctionAnnexe
+    from yao.function.annex.schema import SchemasFunctionAnnexeStoreUpdate
+    path = result_annex_path(prefix, uuid, file.filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.abspath(file.path) != os.path.abspath(path):
+        if not move:
+            shutil.copyfile(file.path, path)
+        else:
+            try:
+                os.replace(file.path, path)
+            except OSError:
+                shutil.move(file.path, path)
+    return CrudFunctionAnnexe.init().store(session=session, item=SchemasFunctionAnnexeStoreUpdate(
+        prefix=prefix, filename=file.filename[:50], content_type=file.content_type[:100],
+        md5=md5_file(path), path=path, size=os.path.getsize(path), width=0, height=0))
+
+
+def discard_result(session, queue, commit: bool = False):
+    """
+    删除队列的结果附件与文件 并清空结果字段
+    :param session:
+    :param queue: 队列对象
+    :param commit:
+    :return:
+    """
+    from sqlalchemy import update
+    from yao.function.model import ModelFunctionAnnexes, ModelFunctionQueues
+    if queue.result_annex:
+        annex = session.query(ModelFunctionAnnexes).filter(ModelFunctionAnnexes.uuid == queue.result_annex).first()
+        if annex is not None:
+            # 结果文件不在共用文件中 只删除自己的文件 删除记录走 ORM 触发附件事件
+            not annex.blob_hash and annex.path and os.path.isfile(annex.path) and os.remove(annex.path)
+            session.delete(annex)
+            session.flush()
+    session.execute(update(ModelFunctionQueues).where(ModelFunctionQueues.id == queue.id).values(result=None, result_annex=None, result_expire_at=None))
+    commit and session.commit()
+
+
+def store_result(session, queue, value, ttl: int = None) -> dict:
+    """
+    保存队列方法的返回值 文件与超过 QUEUE_RESULT_INLINE_MAX 字节的 JSON 写入附件 其余直接存入队列
+    :param session:
+    :param queue: 队列对象
+    :param value: 返回值 None 不保存
+    :param ttl: 保留秒数
+    :return: 需更新的队列字段
+    """
+    from yao.depends import DateEncoder
+    (queue.result is not None or queue.result_annex) and discard_result(session, queue)
+    if value is None:
+        return {}
+    ttl = QUEUE_RESULT_TTL if ttl is None else ttl
+    values = {"result_expire_at": datetime.now() + timedelta(seconds=ttl) if ttl else None}
+    file = result_file(value)
+    if file is None:
+        content = json.dumps(value, cls=DateEncoder, ensure_ascii=False)
+        if len(content.encode("utf-8")) <= QUEUE_RESULT_INLINE_MAX:
+            return dict(values, result={"type": "json", "value": json.loads(content)})
+        path = result_annex_path(queue.prefix, queue.uuid, "result.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        file = QueueResultFile(path, filename="result.json", content_type="application/json", move=True)
+    annex = store_annex(session, queue.prefix, queue.uuid, file)
+    return dict(values, result_annex=annex.uuid, result={"type": "file", "filename": annex.filename, "content_type": annex.content_type, "size": annex.size})
+
+
+def result_download(session, uuid: str, prefix: str = None):
+    """
+    队列结果附件
+    :param session:
+    :param uuid: 队列 uuid
+    :param prefix:
+    :return: 附件对象 或 None
+    """
+    from yao.function.model import ModelFunctionAnnexes, ModelFunctionQueues
+    query = session.query(ModelFunctionAnnexes).join(ModelFunctionQueues, ModelFunctionQueues.result_annex == ModelFunctionAnnexes.uuid).filter(ModelFunctionQueues.uuid == uuid)
+    if prefix:
+        query = query.filter(ModelFunctionQueues.prefix == prefix)
+    annex = query.first()
+    return annex if annex is not None and annex.path and os.path.isfile(annex.path) else None
+
+
+def clean_results(queue=None, auth=None, batch: int = 500, **kwargs) -> int:
+    """
+    清理过期的队列结果 可作为队列任务执行
+    :param queue:
+    :param auth:
+    :param batch:
+    :return: 清理条数
+    """
+    from yao.db import SessionLocal
+    from yao.function.model import ModelFunctionQueues
+    total = 0
+    session = SessionLocal()
+    try:
+        while True:
+            queues = session.query(ModelFunctionQueues).filter(ModelFunctionQueues.result_expire_at < datetime.now()).limit(batch).all()
+            for expired in queues:
+                discard_result(session, expired)
+            session.commit()
+            total += len(queues)
+            if len(queues) < batch:
+                break
+    finally:
+        session.close()
+    return total
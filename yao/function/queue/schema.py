@@ -20,6 +20,11 @@ class SchemasResponse(SchemaPrefixNames):
     progress_text: Optional[str] = None  # 进度条
     retry: Optional[int] = None  # 重试次数
     queue_status: Optional[int] = None  # 状态
+    next_run_at: Optional[datetime] = None  # 下次执行时间
+    locked_until: Optional[datetime] = None  # 运行租约到期时间
+    result: Optional[dict] = None  # 结果
+    result_annex: Optional[str] = None  # 结果附件
+    result_expire_at: Optional[datetime] = None  # 结果过期时间
 
     remarks: Optional[str] = None  # 备注
     sort: Optional[int] = None  # 排序
@@ -43,7 +48,12 @@ class SchemasStoreUpdate(SchemasPrefixOwns):
     progress: Optional[str] = None  # 进度条
     progress_text: Optional[str] = None  # 进度条
     retry: Optional[int] = None  # 重试次数
-    queue_status: Optional[int] = None  # 状态 0未运行 1成功 2失败
+    queue_status: Optional[int] = None  # 状态 0未运行 1成功 2失败 3运行中 4死信
+    next_run_at: Optional[datetime] = None  # 下次执行时间
+    locked_until: Optional[datetime] = None  # 运行租约到期时间
+    result: Optional[dict] = None  # 结果
+    result_annex: Optional[str] = None  # 结果附件
+    result_expire_at: Optional[datetime] = None  # 结果过期时间
 
     remarks: Optional[str] = None  # 备注
     sort: Optional[int] = None  # 排序
@@ -0,0 +1,180 @@
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from config import QUEUE_WORKERS, QUEUE_WORKER_MODE, QUEUE_SCOPE_CONCURRENCY, QUEUE_POLL_INTERVAL, QUEUE_IDLE_INTERVAL
+except:
+    # 同时执行的队列数
+    QUEUE_WORKERS: int = 4
+    # thread 线程池 process 进程池
+    QUEUE_WORKER_MODE: str = "thread"
+    # 每个 scope 的并发上限 {scope: 数量} 未配置的不限制
+    QUEUE_SCOPE_CONCURRENCY: dict = {}
+    # 没有队列时的轮询间隔 秒
+    QUEUE_POLL_INTERVAL: float = 1
+    # 启用 redis 通知后 没有队列时的轮询间隔 秒 (兜底 延时任务/丢失的通知)
+    QUEUE_IDLE_INTERVAL: float = 30
+
+from yao.function.queue.notify import queue_notifier
+
+
+def _process_initializer():
+    """子进程不复用父进程的数据库连接"""
+    from yao.db import Engine
+    Engine.dispose(close=False)
+
+
+def execute_queue(uuid: str) -> bool:
+    """
+    按 uuid 执行已领取的队列 线程池/进程池的执行入口
+    :param uuid:
+    :return:
+    """
+    from yao.db import session as _session
+    from yao.function.queue.crud import Crud as QueueCrud
+    from yao.function.queue.helper import run_queue
+    session = next(_session())
+    try:
+        queue = QueueCrud.init().first(session=session, uuid=uuid)
+        return bool(queue) and run_queue(session=session, queue=queue)
+    finally:
+        session.close()
+
+
+class QueueWorker:
+    """
+    多线程/多进程 执行队列
+    调度线程原子领取队列后提交到执行池 按 scope 限制并发 stop() 后不再领取 等待执行中的队列完成
+    """
+
+    def __init__(self, workers: int = QUEUE_WORKERS, mode: str = QUEUE_WORKER_MODE, scope_concurrency: dict = None, where: list = None,
+                 poll_interval: float = QUEUE_POLL_INTERVAL, idle_interval: float = None):
+        """
+        :param workers: 同时执行的队列数
+        :param mode: thread / process
+        :param scope_concurrency: {scope: 并发上限}
+        :param where: 额外的领取条件
+        :param poll_interval: 没有队列时的轮询间隔 秒
+        :param idle_interval: 收到新队列通知前的最长等待 秒 默认 redis 通知时 QUEUE_IDLE_INTERVAL 否则 poll_interval
+        """
+        self.workers = workers
+        self.mode = mode
+        self.scope_concurrency = QUEUE_SCOPE_CONCURRENCY if scope_concurrency is None else scope_concurrency
+        self.where = where or []
+        self.poll_interval = poll_interval
+        self.idle_interval = idle_interval
+        self.running = {}  # {scope: 执行中数量}
+        self._slots = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._executor = None
+
+    def _full_scopes(self):
+        with self._lock:
+            return [scope for scope, limit in self.scope_concurrency.items() if self.running.get(scope, 0) >= limit]
+
+    def _done(self, scope):
+        def callback(future):
+            with self._lock:
+                self.running[scope] -= 1
+            self._slots.release()
+            self._wake.set()
+
+        return callback
+
+    def claim(self):
+        """
+        领取一条可执行的队列
+        :return: (uuid, scope) 或 None
+        """
+        from yao.db import session as _session
+        from yao.function.queue.helper import claim_queue
+        session = next(_session())
+        try:
+            queue = claim_queue(session=session, where=self.where, exclude_scopes=self._full_scopes())
+            return (queue.uuid, queue.scope) if queue else None
+        finally:
+            session.close()
+
+    def validate(self):
+        """
+        启动时校验待执行队列的方法 不存在的直接标记为死信
+        :return: {(module, function_name): 错误信息}
+        """
+        from yao.db import session as _session
+        from yao.function.queue.registry import validate_handlers
+        session = next(_session())
+        try:
+            return validate_handlers(session=session, where=self.where)
+        finally:
+            session.close()
+
+    def wait(self, timeout: float):
+        """
+        空闲等待 有新队列通知或执行完成时提前唤醒
+        :param timeout:
+        :return:
+        """
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def notify(self):
+        """唤醒调度线程"""
+        self._wake.set()
+
+    def run(self):
+        """
+        调度循环 阻塞直到 stop()
+        :return:
+        """
+        self.validate()
+        pool = ProcessPoolExecutor if self.mode == "process" else ThreadPoolExecutor
+        kwargs = {"initializer": _process_initializer} if self.mode == "process" else {"thread_name_prefix": "yao-queue"}
+        self._executor = pool(max_workers=self.workers, **kwargs)
+        queue_notifier.subscribe(self._wake)
+        idle_interval = self.idle_interval or (QUEUE_IDLE_INTERVAL if queue_notifier.shared else self.poll_interval)
+        try:
+            while not self._stop.is_set():
+                if not self._slots.acquire(timeout=self.poll_interval):
+                    continue
+                try:
+                    claimed = self.claim()
+                except Exception:
+                    claimed = None
+                if not claimed:
+                    self._slots.release()
+                    self.wait(idle_interval)
+                    continue
+                uuid, scope = claimed
+                with self._lock:
+                    self.running[scope] = self.running.get(scope, 0) + 1
+                self._executor.submit(execute_queue, uuid).add_done_callback(self._done(scope))
+        finally:
+            queue_notifier.unsubscribe(self._wake)
+            self._executor.shutdown(wait=True)
+
+    def start(self):
+        """
+        后台线程运行调度
+        :return: threading.Thread
+        """
+        thread = threading.Thread(target=self.run, name="yao-queue-dispatcher", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self, *args):
+        """停止领取 run() 在执行中的队列完成后返回"""
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        """
+        前台运行 SIGINT/SIGTERM 优雅退出
+        :return:
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        self.run()
@@ -1,9 +1,21 @@
 from sqlalchemy.orm import Session
 
+from yao.cache import TTLCache
 from yao.crud import Operation
 from yao.helpers import token_get_password_hash
 from yao.function.model import ModelFunctionUsers, ModelFunctionPermissions, ModelFunctionAppointments
 
+try:
+    from config import OAUTH_AUTH_CACHE_TTL, OAUTH_AUTH_CACHE_SIZE
+except:
+    # 授权用户缓存秒数 0 不缓存
+    OAUTH_AUTH_CACHE_TTL: int = 60
+    # 授权用户缓存条数
+    OAUTH_AUTH_CACHE_SIZE: int = 4096
+
+# 授权用户缓存 {(user_id, token iat, prefix, scopes): SchemasFunctionScopes}
+auth_cache = TTLCache(maxsize=OAUTH_AUTH_CACHE_SIZE, ttl=OAUTH_AUTH_CACHE_TTL)
+
 
 class CrudFunctionUser(Operation):
     """用户表操作"""
@@ -13,24 +25,87 @@ class CrudFunctionUser(Operation):
         "permissions": ModelFunctionPermissions,
         "appointments": ModelFunctionAppointments
     }
+    relations = {
+        "permissions": "selectin",
+        "appointments": "selectin",
+        "children": "selectin"
+    }
 
-    def store(self, item=None, data: dict = None, commit: bool = True, refresh: bool = True, close: bool = False, **kwargs):
-        if hasattr(item, "password") and item.password:
+    def store(self, item=None, data: dict = None, commit: bool = True, refresh: bool = True, close: bool = False, hashed: bool = False, **kwargs):
+        """
+        :param hashed: password 已加密 如路由中已用 token_get_password_hash_async 加密
+        """
+        if not hashed and hasattr(item, "password") and item.password:
             item.password = token_get_password_hash(item.password)
         item.children_ids = [item.username]
         res = super().store(item=item, data=data, commit=commit, refresh=refresh, close=close, **kwargs)
         return res
 
-    def update(self, where=None, item=None, data: dict = None, commit: bool = True, refresh: bool = True, close: bool = False, exclude_unset=True, event: bool = False, **kwargs):
+    def update(self, where=None, item=None, data: dict = None, commit: bool = True, refresh: bool = True, close: bool = False, exclude_unset=True, event: bool = False,
+               hashed: bool = False, **kwargs):
+        """
+        :param hashed: password 已加密
+        """
         if hasattr(item, "password") and item.password:
-            item.password = token_get_password_hash(item.password)
+            if not hashed:
+                item.password = token_get_password_hash(item.password)
         else:
             if hasattr(item, "password"):
                 delattr(item, "password")
         res = super().update(where=where, item=item, data=data, commit=commit, refresh=refresh, close=False, exclude_unset=exclude_unset, event=event, **kwargs)
         self.update_children_ids(close=False, session=kwargs.get("session"))
+        self.auth_cache_invalidate()
         return res
 
+    def delete(self, session, commit: bool = True, close: bool = False, event: bool = False, **kwargs):
+        res = super().delete(session=session, commit=commit, close=close, event=event, **kwargs)
+        self.auth_cache_invalidate()
+        return res
+
+    def many_store(self, session, items: list, commit: bool = True, close: bool = False, **kwargs):
+        items = [dict(item) if isinstance(item, dict) else item for item in items]
+        for item in items:
+            if isinstance(item, dict):
+                if item.get("password"):
+                    item["password"] = token_get_password_hash(item["password"])
+                item["children_ids"] = [item.get("username")]
+                continue
+            if hasattr(item, "password") and item.password:
+                item.password = token_get_password_hash(item.password)
+            item.children_ids = [item.username]
+        return super().many_store(session=session, items=items, commit=commit, close=close, **kwargs)
+
+    def many_update(self, session, instances: list, items: list, commit: bool = True, close: bool = False, exclude_unset=True, **kwargs):
+        items = [dict(item) if isinstance(item, dict) else item for item in items]
+        for item in items:
+            if isinstance(item, dict):
+                if item.get("password"):
+                    item["password"] = token_get_password_hash(item["password"])
+                else:
+                    item.pop("password", None)
+                continue
+            if hasattr(item, "password") and item.password:
+                item.password = token_get_password_hash(item.password)
+            else:
+                if hasattr(item, "password"):
+                    delattr(item, "password")
+        res = super().many_update(session=session, instances=instances, items=items, commit=commit, close=False, exclude_unset=exclude_unset, **kwargs)
+        session.flush()
+        self.update_children_ids(close=close, session=session, commit=commit)
+        self.auth_cache_invalidate()
+        return res
+
+    @staticmethod
+    def auth_cache_invalidate(user_id: int = None):
+        """
+        清除授权用户缓存
+        :param user_id: 用户ID 为空清除全部 (update/delete 的条件不一定能对应到用户ID)
+        :return:
+        """
+        if user_id is None:
+            return auth_cache.clear()
+        return auth_cache.discard(lambda key: key[0] == user_id)
+
     def update_children_ids(self, **kwargs):
         users = self.get(**kwargs)
         for user in users:
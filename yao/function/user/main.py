@@ -37,7 +37,7 @@ except:
 
 from yao.db import session as _session
 from yao.depends import model_screen_params, model_post_screen_params, auth_user
-from yao.helpers import token_access_token, token_verify_password
+from yao.helpers import token_access_token, token_verify_password_async, token_get_password_hash_async, token_login_limiter
 from yao.schema import Schemas, SchemasError, ModelScreenParams
 from yao.function.model import function_user_name as name
 from yao.function.user.crud import CrudFunctionUser
@@ -49,7 +49,7 @@ router = APIRouter(tags=[name.replace('.', ' ').title()])
 user_scopes = [name, ]
 
 
-def authenticate_user(session: Session, username: str, password: str):
+async def authenticate_user(session: Session, username: str, password: str):
     """
     验证用户信息
     :param session:
@@ -58,12 +58,12 @@ def authenticate_user(session: Session, username: str, password: str):
     :return:
     """
     user = CrudFunctionUser.init().first(session=session, where=[("username", username), ("available", True)])
-    if not user or not token_verify_password(plain_password=password, hashed_password=user.password):
+    if not user or not await token_verify_password_async(plain_password=password, hashed_password=user.password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="账号或者密码不正确！")
     return user
 
 
-def token_authenticate_access_token(session, username: str, password: str, scopes: list) -> str:
+async def token_authenticate_access_token(session, username: str, password: str, scopes: list) -> str:
     """
     认证用户且生成用户token
     :param session:
@@ -73,7 +73,7 @@ def token_authenticate_access_token(session, username: str, password: str, scope
     :return:
     """
     from datetime import timedelta
-    user = authenticate_user(session=session, username=username, password=password)
+    user = await authenticate_user(session=session, username=username, password=password)
     access_token_expires = timedelta(minutes=int(OAUTH_ACCESS_TOKEN_EXPIRE_MINUTES))
     scopes = scopes + [OAUTH_LOGIN_SCOPES]
     """处理用户拥有的权限"""
@@ -102,12 +102,13 @@ async def login_for_access_token(session: Session = Depends(_session), form_data
     获取登录授权:
     - **form_data**: 登录数据
     """
-    access_token = token_authenticate_access_token(
-        session=session,
-        username=form_data.username,
-        password=form_data.password,
-        scopes=form_data.scopes
-    )
+    async with token_login_limiter():
+        access_token = await token_authenticate_access_token(
+            session=session,
+            username=form_data.username,
+            password=form_data.password,
+            scopes=form_data.scopes
+        )
     return SchemasLoginResponse(data=SchemasLogin(access_token=access_token, token_type="bearer"), access_token=access_token, token_type="bearer")
 
 
@@ -132,7 +133,10 @@ async def patch_me(item: SchemasFunctionUserSafeUpdate, session: Session = Depen
     """
     更新登录授权用户的信息:
     """
-    bool_model = CrudFunctionUser.init(session=session).update(uuid=auth.user.uuid, item=item)
+    if item.password:
+        item.password = await token_get_password_hash_async(item.password)
+    CrudFunctionUser.init().update(session=session, uuid=auth.user.uuid, item=item, event=True, hashed=True)
+    bool_model = CrudFunctionUser.init().first(session=session, uuid=auth.user.uuid)
     return Schemas(data=SchemasFunctionUserResponse(**bool_model.to_dict()))
 
 
@@ -147,10 +151,11 @@ async def get_models(session: Session = Depends(_session), params: ModelScreenPa
     - **:return**:
     """
     if auth.user.username and auth.user.username.split("@")[0] == DEFAULT_FUNCTION_COMPANY.get("prefix_name") and auth.user.username.split("@")[1] in OAUTH_ADMIN_USERS:
-        db_model_list = CrudFunctionUser.init().paginate(session=session, where=[("parent_id", None) if len(params.where) == 0 else None], screen_params=params)
+        db_model_list = CrudFunctionUser.init().paginate(session=session, where=[("parent_id", None) if len(params.where) == 0 else None], screen_params=params,
+                                                         load=SchemasFunctionUserResponse)
     else:
         db_model_list = CrudFunctionUser.init().paginate(session=session, where=[('prefix', auth.prefix), ("parent_id", None) if len(params.where) == 0 else None],
-                                                         screen_params=params)
+                                                         screen_params=params, load=SchemasFunctionUserResponse)
     return Schemas(data=SchemasPaginateItem(**db_model_list))
 
 
@@ -164,7 +169,7 @@ async def post_models(session: Session = Depends(_session), params: ModelScreenP
     - **:param auth**:
     - **:return**:
     """
-    db_model_list = CrudFunctionUser.init().paginate(session=session, screen_params=params)
+    db_model_list = CrudFunctionUser.init().paginate(session=session, screen_params=params, load=SchemasFunctionUserResponse)
     return Schemas(data=SchemasPaginateItem(**db_model_list))
 
 
@@ -222,7 +227,9 @@ async def store_model(item: SchemasFunctionUserStoreUpdate, session: Session = D
     db_model = CrudFunctionUser.init().first(session=session, where=("username", item.username))
     if db_model is not None:
         return SchemasError(message="数据已经存在！")
-    bool_model = CrudFunctionUser.init().store(session=session, item=item)
+    if item.password:
+        item.password = await token_get_password_hash_async(item.password)
+    bool_model = CrudFunctionUser.init().store(session=session, item=item, hashed=True)
     return Schemas(data=SchemasFunctionUserResponse(**bool_model.to_dict()))
 
 
@@ -236,12 +243,14 @@ async def update_put_model(uuid: str, item: SchemasFunctionUserStoreUpdate, sess
     :param auth:
     :return:
     """
-    db_model = CrudFunctionUser.init(session=session).first(uuid=uuid)
+    db_model = CrudFunctionUser.init().first(session=session, uuid=uuid)
     if db_model is None:
         return SchemasError(message="数据没有找到！")
     item.prefix = item.prefix or auth.prefix
     item.username = "%s@%s" % (auth.prefix, item.username)
-    CrudFunctionUser.init(session=session).update(uuid=uuid, item=item, exclude_unset=False)
+    if item.password:
+        item.password = await token_get_password_hash_async(item.password)
+    CrudFunctionUser.init().update(session=session, uuid=uuid, item=item, exclude_unset=False, hashed=True)
     return Schemas()
 
 
@@ -260,7 +269,9 @@ async def update_patch_model(uuid: str, item: SchemasFunctionUserStoreUpdate, se
     db_model = CrudFunctionUser.init().first(session=session, uuid=uuid)
     if db_model is None:
         return SchemasError(message="数据没有找到！")
-    CrudFunctionUser.init().update(session=session, uuid=uuid, item=item, exclude_unset=True, event=True, close=True)
+    if item.password:
+        item.password = await token_get_password_hash_async(item.password)
+    CrudFunctionUser.init().update(session=session, uuid=uuid, item=item, exclude_unset=True, event=True, close=True, hashed=True)
     return Schemas()
 
 
@@ -78,6 +78,7 @@ class SchemasFunctionUser(BaseModel):
     prefix: Optional[str] = None
     sub: Optional[str] = None
     user_id: Optional[int] = 0
+    iat: Optional[int] = 0
     exp: Optional[int] = 0
     scopes: List[str] = []
 
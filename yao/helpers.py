@@ -1,3 +1,55 @@
+import asyncio
+from functools import lru_cache, partial
+
+from yao.cache import TTLCache
+
+try:
+    from config import OAUTH_HASH_WORKERS, OAUTH_LOGIN_CONCURRENCY
+except:
+    # 密码 hash/验证 线程数
+    OAUTH_HASH_WORKERS: int = 4
+    # 同时处理登录数 超出排队
+    OAUTH_LOGIN_CONCURRENCY: int = 8
+
+try:
+    from config import OAUTH_TOKEN_CACHE_SIZE
+except:
+    # 已验证 token 缓存条数 0 不缓存
+    OAUTH_TOKEN_CACHE_SIZE: int = 4096
+
+# 已验证 token 缓存至 exp {(token, key, algorithm): (payload, frozenset(scopes))}
+token_payload_cache = TTLCache(maxsize=OAUTH_TOKEN_CACHE_SIZE, ttl=60 * 60)
+
+
+@lru_cache()
+def token_crypt_context():
+    """
+    密码 CryptContext 进程内只创建一次
+    :return: CryptContext
+    """
+    from passlib.context import CryptContext
+    return CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+
+@lru_cache()
+def token_executor():
+    """
+    密码 hash/验证 专用线程池 限制 bcrypt 占用的线程数
+    :return: ThreadPoolExecutor
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=OAUTH_HASH_WORKERS, thread_name_prefix="yao-hash")
+
+
+@lru_cache()
+def token_login_limiter():
+    """
+    登录并发限制
+    :return: asyncio.Semaphore
+    """
+    return asyncio.Semaphore(OAUTH_LOGIN_CONCURRENCY)
+
+
 def token_verify_password(plain_password: str, hashed_password: str):
     """
     验证 oauth token密码
@@ -5,10 +57,7 @@ def token_verify_password(plain_password: str, hashed_password: str):
     :param hashed_password: hash 密码
     :return: bool
     """
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
-    return False if not hashed_password else pwd_context.verify(plain_password, hashed_password)
+    return False if not hashed_password else token_crypt_context().verify(plain_password, hashed_password)
 
 
 def token_get_password_hash(password: str):
@@ -17,9 +66,28 @@ def token_get_password_hash(password: str):
     :param password: 加密密码
     :return: hash
     """
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-    return pwd_context.hash(password)
+    return token_crypt_context().hash(password)
+
+
+async def token_verify_password_async(plain_password: str, hashed_password: str):
+    """
+    在 token_executor 中验证密码 不阻塞事件循环
+    :param plain_password: 明文密码
+    :param hashed_password: hash 密码
+    :return: bool
+    """
+    if not hashed_password:
+        return False
+    return await asyncio.get_running_loop().run_in_executor(token_executor(), partial(token_verify_password, plain_password, hashed_password))
+
+
+async def token_get_password_hash_async(password: str):
+    """
+    在 token_executor 中加密 不阻塞事件循环
+    :param password: 加密密码
+    :return: hash
+    """
+    return await asyncio.get_running_loop().run_in_executor(token_executor(), partial(token_get_password_hash, password))
 
 
 def token_access_token(data: dict, key: str, algorithm: str, expires_delta):
@@ -34,8 +102,9 @@ def token_access_token(data: dict, key: str, algorithm: str, expires_delta):
     from datetime import datetime, timedelta
     from jose import jwt
     to_encode = data.copy()
-    expire = datetime.now() + (expires_delta if expires_delta else timedelta(minutes=15))
-    to_encode.update({"exp": expire})
+    now = datetime.now()
+    expire = now + (expires_delta if expires_delta else timedelta(minutes=15))
+    to_encode.update({"iat": now, "exp": expire})
     encoded_jwt = jwt.encode(claims=to_encode, key=key, algorithm=algorithm)
     return encoded_jwt
 
@@ -49,31 +118,53 @@ def token_payload(security_scopes, token, key, algorithm):
     :param algorithm: 加密 算法
     :return:
     """
-    from jose import jwt, JWTError
+    cache_key = (token, key, algorithm)
+    cached = token_payload_cache.get(cache_key) if OAUTH_TOKEN_CACHE_SIZE else None
+    if cached is None:
+        payload = token_decode(security_scopes, token, key, algorithm)
+        cached = (payload, frozenset(payload.get("scopes", [])))
+        OAUTH_TOKEN_CACHE_SIZE and token_payload_cache.set(cache_key, cached, expire_at=payload.get("exp"))
+    payload, token_scopes = cached
+    """排除不授权限管理"""
+    # Todo
+    """排除不授权限管理"""
+    if security_scopes.scopes and not token_scopes.issuperset(security_scopes.scopes):
+        raise token_exception(security_scopes, detail="Not enough permissions")
+    return dict(payload)
+
+
+def token_exception(security_scopes, detail: str = 'Could not validate credentials'):
+    """
+    授权失败异常
+    :param security_scopes: SecurityScopes
+    :param detail:
+    :return: HTTPException
+    """
     from fastapi import HTTPException, status
-    from pydantic import ValidationError
     if security_scopes.scopes:
         authenticate_value = f'Bearer scope="{security_scopes.scope_str}"'
     else:
         authenticate_value = f'Bearer'
-    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                          detail='Could not validate credentials',
-                                          headers={"WWW-Authenticate": authenticate_value})
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail, headers={"WWW-Authenticate": authenticate_value})
+
+
+def token_decode(security_scopes, token, key, algorithm):
+    """
+    验证签名 解析 token
+    :param security_scopes: SecurityScopes
+    :param token: OAuth2PasswordBearer
+    :param key: 加密key
+    :param algorithm: 加密 算法
+    :return: payload
+    """
+    from jose import jwt, JWTError
+    from pydantic import ValidationError
     try:
         payload = jwt.decode(token=token, key=key, algorithms=[algorithm])
-        sub: str = payload.get('sub')
-        if sub is None:
-            raise credentials_exception
-        token_scopes = payload.get("scopes", [])
     except (JWTError, ValidationError):
-        raise credentials_exception
-    """排除不授权限管理"""
-    # Todo
-    """排除不授权限管理"""
-    for scope in security_scopes.scopes:
-        if scope not in token_scopes:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not enough permissions",
-                                headers={"WWW-Authenticate": authenticate_value})
+        raise token_exception(security_scopes)
+    if payload.get('sub') is None:
+        raise token_exception(security_scopes)
     return payload
 
 
@@ -86,24 +177,17 @@ def store_permissions(permissions: list):
     from yao.function.model import SYSTEM_PERMISSIONS
     from yao.db import session
     _session = next(session())
-    # 检查控制台
-    checkPermissionOrStore([{"name": "控制台", "scope": "Dashboard", "icon": "DataBoard"}], session=_session)
-    # 检查其它权限
-    checkPermissionOrStore(permissions, session=_session)
-    # 检查系统权限
-    checkPermissionOrStore(SYSTEM_PERMISSIONS, session=_session)
+    # 控制台 其它权限 系统权限 一次比对 一次提交
+    checkPermissionOrStore([{"name": "控制台", "scope": "Dashboard", "icon": "DataBoard"}] + permissions + SYSTEM_PERMISSIONS, session=_session)
 
 
-def checkPermissionOrStore(permissions: list, session=None, parent_pk: str = None):
+def permission_nodes(permissions: list, parent_scope: str = None):
     """
-    检查或者创建权限
+    展开权限树 先序 叶子节点追加动作权限
     :param permissions:
-    :param session:
-    :param parent_pk:
-    :return:
+    :param parent_scope:
+    :return: [(scope, parent_scope, {name, scope, is_menu, is_action, icon}), ...]
     """
-    from yao.function.permission.crud import CrudFunctionPermission
-    from yao.function.permission.schema import SchemasFunctionStoreUpdate as SchemasFunctionPermissionStoreUpdate
     ACTION_ITEMS = [
         {"name": "列表", "scope": "list"},
         {"name": "详情", "scope": "get"},
@@ -113,35 +197,92 @@ def checkPermissionOrStore(permissions: list, session=None, parent_pk: str = Non
         {"name": "导出", "scope": "export"},
         {"name": "导入", "scope": "import"}
     ]
-
-    permissionObj = CrudFunctionPermission.init()
     for permission in permissions:
         _scope = permission.get('scope')
         _name = permission.get('name')
-        _action = permission.get('action', [])
         _children = permission.get('children', None)
-        _is_menu = permission.get('is_menu', True)
-        _is_action = permission.get('is_action', False)
-        icon = permission.get('icon', None)
-        parent = permissionObj.find_or_store_model(
-            session=session,
-            where=('scope', _scope), item=SchemasFunctionPermissionStoreUpdate(
-                name=_name, scope=_scope, parent_id=parent_pk, is_menu=_is_menu, is_action=_is_action, icon=icon
-            ), commit=True, refresh=False
-        )
+        yield _scope, parent_scope, {
+            "name": _name, "scope": _scope, "is_menu": permission.get('is_menu', True), "is_action": permission.get('is_action', False), "icon": permission.get('icon', None)
+        }
         if _children:
-            checkPermissionOrStore(_children, session=session, parent_pk=parent.uuid)
+            yield from permission_nodes(_children, parent_scope=_scope)
         else:
-            for action in (ACTION_ITEMS + _action):
+            for action in (ACTION_ITEMS + permission.get('action', [])):
                 scope = "%s.%s" % (_scope, action.get('scope'))
-                name = "%s %s" % (_name, action.get('name'))
-                is_menu = action.get('is_menu', False)
-                is_action = action.get('is_action', True)
-                permissionObj.find_or_store_model(
-                    session=session, where=('scope', scope), item=SchemasFunctionPermissionStoreUpdate(
-                        name=name, scope=scope, parent_id=parent.uuid, is_menu=is_menu, is_action=is_action
-                    ), commit=True, refresh=False
-                )
+                yield scope, _scope, {
+                    "name": "%s %s" % (_name, action.get('name')), "scope": scope, "is_menu": action.get('is_menu', False), "is_action": action.get('is_action', True), "icon": None
+                }
+
+
+def checkPermissionOrStore(permissions: list, session=None, parent_pk: str = None, commit: bool = True):
+    """
+    检查或者创建权限
+    一次查询已有权限 批量创建缺少的权限 一次计算左右值 一次提交
+    :param permissions:
+    :param session:
+    :param parent_pk:
+    :param commit:
+    :return: 新建权限数
+    """
+    from uuid import uuid4
+    from sqlalchemy import update, bindparam
+    from yao.function.permission.crud import CrudFunctionPermission
+    from yao.function.model import ModelFunctionPermissions as Model
+
+    table = Model.__table__
+    existing = {row.scope: row for row in session.query(Model.uuid, Model.scope, Model.parent_id, Model.tree_id, Model.left, Model.right, Model.level).all()}
+    uuids = {scope: row.uuid for scope, row in existing.items()}
+    rows = []
+    for scope, parent_scope, item in permission_nodes(permissions):
+        if scope in uuids:
+            continue
+        uuids[scope] = uuid4().hex
+        rows.append({**item, "uuid": uuids[scope], "parent_id": uuids[parent_scope] if parent_scope else parent_pk, "path": "/%s" % scope.replace('.', '/').lower()})
+    if not rows:
+        return 0
+
+    # 重新计算整棵树 已有节点保持原顺序 新节点追加在兄弟节点之后
+    nodes = [{"uuid": row.uuid, "parent_id": row.parent_id, "tree_id": row.tree_id, "lft": row.left, "rgt": row.right, "level": row.level}
+             for row in sorted(existing.values(), key=lambda r: (r.tree_id or 0, r.left or 0))] + [{"uuid": row["uuid"], "parent_id": row["parent_id"]} for row in rows]
+    children = {}
+    for node in nodes:
+        children.setdefault(node["parent_id"], []).append(node)
+    tree_id = max([node.get("tree_id") or 0 for node in nodes])
+
+    def walk(node, left, level):
+        node["new_lft"], node["new_level"] = left, level
+        for child in children.get(node["uuid"], []):
+            child["new_tree_id"] = node["new_tree_id"]
+            left = walk(child, left + 1, level + 1)
+        node["new_rgt"] = left + 1
+        return left + 1
+
+    known = {node["uuid"] for node in nodes}
+    for root in [node for node in nodes if node["parent_id"] not in known]:
+        if not root.get("tree_id"):
+            tree_id += 1
+        root["new_tree_id"] = root.get("tree_id") or tree_id
+        walk(root, 1, Model.get_default_level())
+
+    created = {row["uuid"]: row for row in rows}
+    changed = []
+    for node in nodes:
+        values = {"tree_id": node["new_tree_id"], "lft": node["new_lft"], "rgt": node["new_rgt"], "level": node["new_level"]}
+        if node["uuid"] in created:
+            created[node["uuid"]].update(values)
+        elif any(node[key] != value for key, value in values.items()):
+            changed.append({"_uuid": node["uuid"], **values})
+    try:
+        if changed:
+            session.execute(update(table).where(table.c.uuid == bindparam("_uuid")).values(
+                tree_id=bindparam("tree_id"), lft=bindparam("lft"), rgt=bindparam("rgt"), level=bindparam("level")
+            ), changed)
+        CrudFunctionPermission.init().many_store(session=session, items=rows, commit=False, bulk=True)
+    except Exception:
+        session.rollback()
+        raise
+    commit and session.commit()
+    return len(rows)
 
 
 def init_user_and_password(users: dict, company: dict):
@@ -156,10 +297,9 @@ def init_user_and_password(users: dict, company: dict):
     from yao.db import session
     _session = next(session())
 
-    return [CrudFunctionUser.init().update_or_store_model(
-        session=_session, where=('username', "%s@%s" % (company.get("prefix_name"), username)),
-        item=SchemasFunctionUserStoreUpdate(username="%s@%s" % (company.get("prefix_name"), username), password=password, prefix=company.get("prefix_name")))
-        for username, password in users.items()]
+    items = [SchemasFunctionUserStoreUpdate(username="%s@%s" % (company.get("prefix_name"), username), password=password, prefix=company.get("prefix_name"))
+             for username, password in users.items()]
+    return list(CrudFunctionUser.init().update_or_store_models(session=_session, key="username", items=items).values())
 
 
 def init_function_company(company: dict):
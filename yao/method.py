@@ -341,16 +341,10 @@ def filter_None_key(data):
     return data
 
 
-def get_attr(object, name: str, default=None):
+def attr_value(object):
     """
-    获取对象属性 多层 以.分割
+    导出用的属性值 None 为空字符串 布尔为 1/0 dict 为 JSON
     """
-    _name = name.split('.')
-    for name in _name:
-        if type(object) is dict:
-            object = object.get(name, default)
-        else:
-            object = getattr(object, name, default)
     if object is None:
         object = ""
     if object is True:
@@ -362,6 +356,65 @@ def get_attr(object, name: str, default=None):
     return object
 
 
+def get_attr(object, name: str, default=None):
+    """
+    获取对象属性 多层 以.分割
+    """
+    _name = name.split('.')
+    for name in _name:
+        if type(object) is dict:
+            object = object.get(name, default)
+        else:
+            object = getattr(object, name, default)
+    return attr_value(object)
+
+
+def attr_getter(name: str, default=None, value=attr_value):
+    """
+    预编译 get_attr 只分割一次路径 返回取值函数
+    :param name: 多层 以.分割
+    :param default:
+    :param value: 取值后的转换 默认同 get_attr
+    :return: getter(object)
+    """
+    names = tuple(name.split('.'))
+    if len(names) == 1:
+        name = names[0]
+        return lambda object: value(object.get(name, default) if type(object) is dict else getattr(object, name, default))
+
+    def getter(object):
+        for _name in names:
+            object = object.get(_name, default) if type(object) is dict else getattr(object, _name, default)
+        return value(object)
+
+    return getter
+
+
+def query_rows(db_list, chunk_size: int = 1000):
+    """
+    逐行读取数据 Query 使用 yield_per 分批取出 其它可迭代对象原样返回
+    :param db_list: Query / 生成器 / 列表
+    :param chunk_size:
+    :return:
+    """
+    return db_list.yield_per(chunk_size) if hasattr(db_list, "yield_per") else db_list
+
+
+def export_rows(col_items: dict, db_list, is_header=True, chunk_size: int = 1000):
+    """
+    生成导出行 col_items 的取值函数只编译一次
+    :param col_items: {属性路径: 表头}
+    :param db_list: Query / 生成器 / 列表 list 类型的行原样输出
+    :param is_header:
+    :param chunk_size:
+    :return: 生成器
+    """
+    is_header and (yield list(col_items.values()))
+    getters = [attr_getter(key, "") for key in col_items]
+    for db_obj in query_rows(db_list, chunk_size):
+        yield db_obj if type(db_obj) is list else [getter(db_obj) for getter in getters]
+
+
 def export_file(sheet_name: str, export_name: str, col_items: dict = {}, db_list: list = [], is_header=True):
     """
     导出文件
@@ -370,16 +423,9 @@ def export_file(sheet_name: str, export_name: str, col_items: dict = {}, db_list
     wb = Workbook()
     ws = wb.active
     ws.title = sheet_name
-    is_header and ws.append([datum for datum in col_items.values()])
     # [ws.append([str(get_attr(db_obj, key, "")) for key in col_items]) for db_obj in db_list]
-    for db_obj in db_list:
-        if type(db_obj) is list:
-            ws.append(db_obj)
-        else:
-            _list = []
-            for key in col_items:
-                _list.append(get_attr(db_obj, key, ""))
-            ws.append(_list)
+    for row in export_rows(col_items, db_list, is_header=is_header):
+        ws.append(row)
 
     if not os.path.exists(os.path.dirname(export_name)):
         os.makedirs(os.path.dirname(export_name))
@@ -394,17 +440,8 @@ def export_files(export_name: str, sheet_data: list):
     wb = Workbook()
     for key, sheet in enumerate(sheet_data):
         ws = wb.create_sheet(sheet.get("sheet_name"), key)
-        header_label = sheet.get("col_items", {})
-        if sheet.get("is_label", True):
-            ws.append([datum for datum in header_label.values()])
-        for db_obj in sheet.get("db_list", []):
-            if type(db_obj) is list:
-                ws.append(db_obj)
-            else:
-                _list = []
-                for key in header_label.keys():
-                    _list.append(get_attr(db_obj, key, ""))
-                ws.append(_list)
+        for row in export_rows(sheet.get("col_items", {}), sheet.get("db_list", []), is_header=sheet.get("is_label", True)):
+            ws.append(row)
 
         if not os.path.exists(os.path.dirname(export_name)):
             os.makedirs(os.path.dirname(export_name))
@@ -426,6 +463,168 @@ def export_file_to_dict(sheet_name: str, export_name: str, col_items: dict, db_l
     return wb.save(export_name)
 
 
+def export_stream(sheet_name: str, export_name, col_items: dict = {}, db_list=(), is_header=True, chunk_size: int = 1000):
+    """
+    流式导出文件 write_only 模式逐行写入 不在内存中保留整个工作簿
+    :param sheet_name:
+    :param export_name: 文件路径 或 可写的文件对象
+    :param col_items: {属性路径: 表头}
+    :param db_list: Query(按 chunk_size 分批 yield_per) / 生成器 / 列表
+    :param is_header:
+    :param chunk_size:
+    :return: export_name
+    """
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    for row in export_rows(col_items, db_list, is_header=is_header, chunk_size=chunk_size):
+        ws.append(row)
+    if isinstance(export_name, (str, os.PathLike)) and os.path.dirname(export_name) and not os.path.exists(os.path.dirname(export_name)):
+        os.makedirs(os.path.dirname(export_name))
+    wb.save(export_name)
+    return export_name
+
+
+def export_text_chunks(col_items: dict = {}, db_list=(), format: str = "csv", is_header=True, encoding: str = None, compress: bool = False, chunk_size: int = 1000,
+                       delimiter: str = ",", block_size: int = 64 * 1024):
+    """
+    流式生成 csv / jsonl 内容 按 block_size 输出 可边生成边 gzip 压缩
+    :param col_items: {属性路径: 表头} jsonl 以属性路径为键
+    :param db_list: Query(按 chunk_size 分批 yield_per) / 生成器 / 列表 list 类型的行原样输出
+    :param format: csv / jsonl
+    :param is_header: csv 表头
+    :param encoding: 默认 csv 为 utf-8-sig(带 BOM 兼容 Excel) jsonl 为 utf-8
+    :param compress: gzip
+    :param chunk_size:
+    :param delimiter: csv 分隔符
+    :param block_size:
+    :return: 生成器 bytes
+    """
+    import io
+    import csv
+    import zlib
+    import codecs
+    encoder = codecs.getincrementalencoder(encoding or ("utf-8" if format == "jsonl" else "utf-8-sig"))()
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+
+    def output(final=False):
+        data = encoder.encode(buffer.getvalue(), final=final)
+        buffer.seek(0)
+        buffer.truncate()
+        if compressor is not None:
+            data = compressor.compress(data) + (compressor.flush() if final else b"")
+        return data
+
+    if format == "jsonl":
+        keys = list(col_items)
+        getters = [attr_getter(key, value=lambda value: value) for key in keys]
+        for db_obj in query_rows(db_list, chunk_size):
+            values = db_obj if type(db_obj) is list else [getter(db_obj) for getter in getters]
+            buffer.write(json.dumps(dict(zip(keys, values)), ensure_ascii=False, default=str) + "\n")
+            if buffer.tell() >= block_size:
+                yield output()
+    else:
+        writer = csv.writer(buffer, delimiter=delimiter)
+        for row in export_rows(col_items, db_list, is_header=is_header, chunk_size=chunk_size):
+            writer.writerow(row)
+            if buffer.tell() >= block_size:
+                yield output()
+    data = output(final=True)
+    data and (yield data)
+
+
+def export_text(export_name, col_items: dict = {}, db_list=(), format: str = None, compress: bool = None, **kwargs):
+    """
+    流式导出 csv / jsonl 文件
+    :param export_name: 文件路径 或 可写的二进制文件对象
+    :param col_items: {属性路径: 表头}
+    :param db_list: Query / 生成器 / 列表
+    :param format: 默认按扩展名
+    :param compress: 默认按 .gz 扩展名
+    :param kwargs: 见 export_text_chunks
+    :return: export_name
+    """
+    is_path = isinstance(export_name, (str, os.PathLike))
+    compress = str(export_name).endswith(".gz") if compress is None and is_path else bool(compress)
+    chunks = export_text_chunks(col_items, db_list, format=import_format(export_name, format), compress=compress, **kwargs)
+    if not is_path:
+        for chunk in chunks:
+            export_name.write(chunk)
+        return export_name
+    if os.path.dirname(export_name) and not os.path.exists(os.path.dirname(export_name)):
+        os.makedirs(os.path.dirname(export_name))
+    with open(export_name, "wb") as file:
+        for chunk in chunks:
+            file.write(chunk)
+    return export_name
+
+
+def export_text_response(filename: str, col_items: dict = {}, db_list=(), format: str = None, compress: bool = None, **kwargs):
+    """
+    csv / jsonl 边查询边输出的下载响应
+    :param filename: 下载文件名 未指定 format compress 时按扩展名
+    :param col_items: {属性路径: 表头}
+    :param db_list: Query / 生成器 / 列表
+    :param format:
+    :param compress:
+    :param kwargs: 见 export_text_chunks
+    :return: StreamingResponse
+    """
+    from fastapi.responses import StreamingResponse
+    format = import_format(filename, format)
+    compress = filename.lower().endswith(".gz") if compress is None else compress
+    media_type = "application/gzip" if compress else "application/x-ndjson" if format == "jsonl" else "text/csv"
+    return StreamingResponse(export_text_chunks(col_items, db_list, format=format, compress=compress, **kwargs), media_type=media_type, headers=download_headers(filename))
+
+
+def file_chunks(file, block_size: int = 64 * 1024):
+    """
+    分块读取文件对象
+    :param file:
+    :param block_size:
+    :return: 生成器
+    """
+    while True:
+        chunk = file.read(block_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def download_headers(filename: str) -> dict:
+    """
+    下载响应头 兼容中文文件名
+    :param filename:
+    :return:
+    """
+    from urllib.parse import quote
+    return {"Content-Disposition": "attachment; filename*=utf-8''%s" % quote(filename)}
+
+
+def export_response(sheet_name: str, filename: str, col_items: dict = {}, db_list=(), is_header=True, chunk_size: int = 1000):
+    """
+    流式导出为下载响应 在线程池中写入临时文件后分块输出 查询使用的 session 需在响应结束后关闭(依赖注入的 session 即可)
+    :param sheet_name:
+    :param filename: 下载文件名
+    :param col_items: {属性路径: 表头}
+    :param db_list: Query / 生成器 / 列表
+    :param is_header:
+    :param chunk_size:
+    :return: StreamingResponse
+    """
+    import tempfile
+    from fastapi.responses import StreamingResponse
+
+    def content():
+        with tempfile.TemporaryFile() as file:
+            export_stream(sheet_name, file, col_items, db_list, is_header=is_header, chunk_size=chunk_size)
+            file.seek(0)
+            yield from file_chunks(file)
+
+    return StreamingResponse(content(), media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=download_headers(filename))
+
+
 def import_file(file: str, sheet: int = 0) -> list:
     """读取excel文件内容"""
     from openpyxl import load_workbook
@@ -449,6 +648,200 @@ def import_file(file: str, sheet: int = 0) -> list:
     return content
 
 
+def import_rows(file, sheet=0, min_row: int = 1):
+    """
+    流式读取excel文件 read_only 模式逐行读取 字符串去除首尾空白
+    :param file: 文件路径 或 文件对象
+    :param sheet: 表格序号 或 名称
+    :param min_row: 起始行 从 1 开始
+    :return: 生成器 [值, ...]
+    """
+    from openpyxl import load_workbook
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if type(sheet) is str else wb.worksheets[sheet]
+        for row in ws.iter_rows(min_row=min_row, values_only=True):
+            yield [(value.strip() if type(value) == str else value) for value in row]
+    finally:
+        wb.close()
+
+
+def import_total(file, sheet=0) -> int:
+    """
+    excel 表格的数据行数(不含表头) 读取表格尺寸 没有尺寸信息时为 0
+    :param file:
+    :param sheet:
+    :return:
+    """
+    from openpyxl import load_workbook
+    wb = load_workbook(file, read_only=True)
+    try:
+        ws = wb[sheet] if type(sheet) is str else wb.worksheets[sheet]
+        return max((ws.max_row or 1) - 1, 0)
+    finally:
+        wb.close()
+
+
+def import_format(file, format: str = None) -> str:
+    """
+    导入导出格式 未指定时按文件扩展名 .csv .jsonl 其它为 xlsx 可带 .gz
+    :param file: 文件路径 或 带 name 的文件对象
+    :param format: csv / jsonl / xlsx
+    :return:
+    """
+    if format:
+        return format
+    name = str(file if isinstance(file, (str, os.PathLike)) else getattr(file, "name", "") or "").lower()
+    name = name[:-3] if name.endswith(".gz") else name
+    return {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(os.path.splitext(name)[-1], "xlsx")
+
+
+def open_text(file, encoding: str = "utf-8-sig"):
+    """
+    以文本方式打开文件 gzip 文件自动解压
+    :param file: 文件路径 或 二进制文件对象
+    :param encoding:
+    :return: 文本文件对象
+    """
+    import io
+    import gzip
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as binary:
+            is_gzip = binary.read(2) == b"\x1f\x8b"
+        return gzip.open(file, "rt", encoding=encoding, newline="") if is_gzip else open(file, "r", encoding=encoding, newline="")
+    if not (hasattr(file, "readable") and hasattr(file, "seekable")):
+        # Python 3.11 之前 SpooledTemporaryFile (UploadFile.file) 不是 IOBase 不能直接给 TextIOWrapper 复制到临时文件
+        import shutil
+        import tempfile
+        copy = tempfile.TemporaryFile()
+        file.seek(0)
+        shutil.copyfileobj(file, copy)
+        copy.seek(0)
+        file = copy
+    is_gzip = file.read(2) == b"\x1f\x8b"
+    file.seek(0)
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=file, mode="rb") if is_gzip else file, encoding=encoding, newline="")
+
+
+def import_records(file, col_items: dict = None, sheet=0, format: str = None, encoding: str = "utf-8-sig", delimiter: str = ","):
+    """
+    逐行读取 xlsx / csv / jsonl 按 col_items 映射字段 跳过空行
+    :param file: 文件路径 或 文件对象
+    :param col_items: {字段: 表头} 为空时以表头为字段
+    :param sheet: xlsx 表格
+    :param format: 见 import_format
+    :param encoding: csv / jsonl 编码
+    :param delimiter: csv 分隔符
+    :return: 生成器 (行号, {字段: 值})
+    """
+    import csv
+    labels = {label: key for key, label in col_items.items()} if col_items else {}
+    field = lambda label: labels.get(label, label if not col_items or label in col_items else None)
+    format = import_format(file, format)
+    if format == "jsonl":
+        with open_text(file, encoding) as text:
+            for number, line in enumerate(text, start=1):
+                if line.strip():
+                    datum = json.loads(line)
+                    yield number, {key: value for key, value in ((field(label), value) for label, value in datum.items()) if key not in [None, ""]}
+        return
+    if format == "csv":
+        text = open_text(file, encoding)
+        rows = ([(value.strip() or None) for value in row] for row in csv.reader(text, delimiter=delimiter))
+    else:
+        text, rows = None, import_rows(file, sheet=sheet)
+    try:
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [(index, field(label)) for index, label in enumerate(header)]
+        columns = [(index, key) for index, key in columns if key not in [None, ""]]
+        for number, row in enumerate(rows, start=2):
+            if all(value in [None, ""] for value in row):
+                continue
+            yield number, {key: (row[index] if index < len(row) else None) for index, key in columns}
+    finally:
+        text is not None and text.close()
+
+
+def import_batches(file, col_items: dict = None, sheet=0, batch_size: int = 1000, **kwargs):
+    """
+    按表头分批读取 xlsx / csv / jsonl 跳过空行
+    :param file:
+    :param col_items: {字段: 表头} 为空时以表头为字段
+    :param sheet:
+    :param batch_size:
+    :param kwargs: 见 import_records
+    :return: 生成器 [(行号, {字段: 值}), ...]
+    """
+    batch = []
+    for record in import_records(file, col_items=col_items, sheet=sheet, **kwargs):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    batch and (yield batch)
+
+
+def import_validate(batch: list, schema):
+    """
+    整批校验 全部通过时只校验一次 有错误时剔除错误行后再校验其余行
+    :param batch: [(行号, {字段: 值}), ...]
+    :param schema: pydantic 模型
+    :return: ([(行号, 模型), ...], [{"row": 行号, "errors": [...]}, ...])
+    """
+    from typing import List
+    from pydantic import ValidationError, parse_obj_as
+    numbers = [number for number, _ in batch]
+    data = [datum for _, datum in batch]
+    try:
+        return list(zip(numbers, parse_obj_as(List[schema], data))), []
+    except ValidationError as e:
+        failed = {}
+        for error in e.errors():
+            index = next(loc for loc in error["loc"] if type(loc) is int)
+            failed.setdefault(index, []).append({"field": ".".join(str(loc) for loc in error["loc"][error["loc"].index(index) + 1:]), "message": error["msg"]})
+    valid = [index for index in range(len(batch)) if index not in failed]
+    items = list(zip([numbers[index] for index in valid], parse_obj_as(List[schema], [data[index] for index in valid]))) if valid else []
+    return items, [{"row": numbers[index], "errors": errors} for index, errors in sorted(failed.items())]
+
+
+def import_store(crud, session, file, schema, col_items: dict = None, sheet=0, chunk_size: int = 1000, bulk: bool = False, progress=None,
+                 max_errors: int = 1000, defaults: dict = None, format: str = None, encoding: str = "utf-8-sig", **kwargs) -> dict:
+    """
+    流式导入 xlsx / csv / jsonl 分批校验后用 crud.many_store 写入 每批一次提交 错误行记录后跳过
+    :param crud: 表操作实例 如 CrudFunctionUser.init()
+    :param session:
+    :param file: 文件路径 或 文件对象 csv / jsonl 可为 gzip
+    :param schema: 每行的 pydantic 模型
+    :param col_items: {字段: 表头} 为空时以表头为字段
+    :param sheet:
+    :param chunk_size: 每批条数
+    :param bulk: 见 many_store 默认逐条 ORM 写入 会触发模型事件
+    :param progress: 进度回调 (progress, progress_text) 队列中可传 functools.partial(progress_queue, queue)
+    :param max_errors: 最多记录的错误行数
+    :param defaults: 每行的默认值 如 {"prefix": auth.prefix}
+    :param format: xlsx / csv / jsonl 默认按扩展名
+    :param encoding: csv / jsonl 编码
+    :param kwargs: 传给 many_store 如 upsert conflict
+    :return: {"total": 读取行数, "stored": 写入行数, "failed": 错误行数, "errors": [{"row": 行号, "errors": [...]}, ...]}
+    """
+    format = import_format(file, format)
+    total = progress and format == "xlsx" and import_total(file, sheet=sheet)
+    response = {"total": 0, "stored": 0, "failed": 0, "errors": []}
+    for batch in import_batches(file, col_items=col_items, sheet=sheet, batch_size=chunk_size, format=format, encoding=encoding):
+        defaults and [datum.update({key: value for key, value in defaults.items() if datum.get(key) is None}) for _, datum in batch]
+        items, errors = import_validate(batch, schema)
+        if items:
+            crud.many_store(session=session, items=[item for _, item in items], commit=True, bulk=bulk, chunk_size=chunk_size, **kwargs)
+        response["total"] += len(batch)
+        response["stored"] += len(items)
+        response["failed"] += len(errors)
+        response["errors"].extend(errors[:max(max_errors - len(response["errors"]), 0)])
+        progress and progress("%.1f%%" % min(response["total"] * 100 / total, 99.9) if total else None, "%d/%d" % (response["total"], total) if total else str(response["total"]))
+    return response
+
+
 def export_demo(sheet_name: str, export_name: str, col_items: dict, db_list: list):
     """https://www.cnblogs.com/MDD-Blog/p/14187228.html"""
     from openpyxl import Workbook
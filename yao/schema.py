@@ -38,12 +38,16 @@ class SchemasPaginate(BaseModel):
     pages: Optional[int] = None  # 总页数
     total: Optional[int] = None  # 总条数
     limit: Optional[int] = None  # 页条数
+    next_cursor: Optional[str] = None  # 下一页游标
+    prev_cursor: Optional[str] = None  # 上一页游标
 
 
 class ModelScreenParams(BaseModel):
     """获取列表默认参数"""
     page: Optional[int] = 1
     limit: Optional[int] = 25
+    cursor: Optional[str] = None  # 游标分页 空字符串为第一页
+    total: Optional[Union[bool, str]] = None  # 总条数 默认精确统计 false 不统计 estimate 估算
     where: Optional[Union[dict, list]] = []
     join: Optional[Union[dict, list]] = []
     order: Optional[list] = []